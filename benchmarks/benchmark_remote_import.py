@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Module Name: benchmark_remote_import.py
+Description: Filesystem-level benchmark of the scan, copy, reconcile and attach paths of
+RemoteImport.py and FetchAndAttach.py. Generates a synthetic OMERO_ImportData/<username>/ tree
+and runs every phase against it with a fake gateway and a fake omero.cli.CLI instead of an OMERO server.
+Reports latency and throughput per phase.
+Prerequisite: the python environment of the OMERO server (omero-py, omero-upload), no running server.
+Usage: python benchmarks/benchmark_remote_import.py --depth 2 --fanout 4 --files 50 --size 1M
+License: GPL v3
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "scripts")
+USER_NAME = "benchmark"
+USER_ID = 1
+WORKSTATION = "bench-ws"
+IMAGE_SUFFIX = ".tif"
+ATTACH_SUFFIXES = [".txt", ".xml"]
+
+
+def load_script(name):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(SCRIPTS_DIR, name + ".py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def parse_size(value):
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    if value[-1].upper() in units:
+        return int(float(value[:-1]) * units[value[-1].upper()])
+    return int(value)
+
+
+########## SYNTHETIC DATA ##############################
+
+# creates <root>/OMERO_ImportData/<username>/ with fanout subdirectories per level down to depth,
+# files_per_dir files per directory (images and attachments) with sizes around file_size
+def generate_tree(root, depth, fanout, files_per_dir, file_size, attach_share, seed=0):
+    rnd = random.Random(seed)
+    block = os.urandom(1024 * 1024)
+    user_dir = os.path.join(root, "OMERO_ImportData", USER_NAME)
+    num_files = 0
+    num_bytes = 0
+
+    def fill(path, level):
+        nonlocal num_files, num_bytes
+        os.makedirs(path, exist_ok=True)
+        for i in range(files_per_dir):
+            if rnd.random() < attach_share:
+                name = "meta_%d%s" % (i, rnd.choice(ATTACH_SUFFIXES))
+            else:
+                name = "image_%d%s" % (i, IMAGE_SUFFIX)
+            size = max(1, int(file_size * rnd.uniform(0.5, 1.5)))
+            with open(os.path.join(path, name), "wb") as f:
+                remaining = size
+                while remaining > 0:
+                    f.write(block[:min(remaining, len(block))])
+                    remaining -= len(block)
+            num_files += 1
+            num_bytes += size
+        if level < depth:
+            for d in range(fanout):
+                fill(os.path.join(path, "dir%d" % d), level + 1)
+
+    fill(user_dir, 0)
+    return user_dir, num_files, num_bytes
+
+
+########## FAKE OMERO ##################################
+
+class FakeWrapper:
+    OMERO_CLASS = "Dataset"
+
+    def __init__(self, conn, obj_id, name, children=None):
+        self.conn = conn
+        self.obj_id = obj_id
+        self.name = name
+        self.children = children or []
+
+    def getId(self):
+        return self.obj_id
+
+    def getName(self):
+        return self.name
+
+    def listChildren(self):
+        return self.children
+
+    def getParent(self):
+        return self.conn.project
+
+    def linkAnnotation(self, ann):
+        self.conn.calls["linkAnnotation"] += 1
+
+
+class FakeProject(FakeWrapper):
+    OMERO_CLASS = "Project"
+
+
+class FakeUser:
+    def getName(self):
+        return USER_NAME
+
+    def getId(self):
+        return USER_ID
+
+
+class FakeUpdateService:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def _assign_ids(self, objects):
+        from omero.rtypes import rlong
+        for obj in objects:
+            child = obj.getChild() if hasattr(obj, "getChild") else None
+            if child is not None and child.getId() is None:
+                child.setId(rlong(self.conn.next_id()))
+        return objects
+
+    def saveAndReturnArray(self, objects):
+        self.conn.calls["saveAndReturnArray"] += 1
+        return self._assign_ids(objects)
+
+    def saveArray(self, objects):
+        self.conn.calls["saveArray"] += 1
+
+    def saveObject(self, obj):
+        self.conn.calls["saveObject"] += 1
+
+    def saveAndReturnObject(self, obj):
+        self.conn.calls["saveAndReturnObject"] += 1
+        return obj
+
+
+class FakeSession:
+    def getAdminService(self):
+        return self
+
+    def getEventContext(self):
+        return None
+
+
+class FakeClient:
+    """the calls are counted per root client, shared with the clients (session pool) created from it"""
+
+    def __init__(self, calls=None):
+        self.calls = calls if calls is not None else {
+            "saveAndReturnArray": 0, "saveArray": 0, "saveObject": 0, "saveAndReturnObject": 0,
+            "createFileAnnfromLocalFile": 0, "linkAnnotation": 0}
+
+    def createClient(self, secure=True):
+        return FakeClient(self.calls)
+
+    def getSession(self):
+        return FakeSession()
+
+    def closeSession(self):
+        pass
+
+
+class FakeGateway:
+    """stands in for omero.gateway.BlitzGateway, counts the server calls (on the counter of its client)"""
+
+    def __init__(self, client_obj=None):
+        self.c = client_obj or FakeClient()
+        self.calls = self.c.calls
+        self.last_id = 1000
+        self.project = FakeProject(self, 1, "benchmark")
+        self.dataset = FakeWrapper(self, 2, "benchmark")
+
+    def next_id(self):
+        self.last_id += 1
+        return self.last_id
+
+    def getUser(self):
+        return FakeUser()
+
+    def getUpdateService(self):
+        return FakeUpdateService(self)
+
+    def getObject(self, obj_type, obj_id):
+        if obj_type == "Project":
+            return self.project
+        return FakeWrapper(self, obj_id, "dataset_%s" % obj_id)
+
+    def createFileAnnfromLocalFile(self, path, **kwargs):
+        self.calls["createFileAnnfromLocalFile"] += 1
+        return FakeWrapper(self, self.next_id(), os.path.basename(path))
+
+    def close(self):
+        pass
+
+
+class FakeCLI:
+    """stands in for omero.cli.CLI: 'imports' every *IMAGE_SUFFIX file and writes the importer log lines"""
+
+    def loadplugins(self):
+        pass
+
+    def set_client(self, client):
+        pass
+
+    def invoke(self, args, strict=False):
+        errs = args[args.index("--errs") + 1]
+        depth = int(args[args.index("--depth") + 1])
+        paths = [a for a in args[args.index("--depth") + 2:args.index("--file")] if not a.startswith("--")]
+        with open(errs, "a") as log:
+            for path in paths:
+                if os.path.isfile(path):
+                    files = [path]
+                else:
+                    files = []
+                    for root, dirs, names in os.walk(path):
+                        if root[len(path):].count(os.sep) >= depth - 1:
+                            dirs.clear()
+                        files.extend(os.path.join(root, n) for n in names)
+                for f in files:
+                    if f.endswith(IMAGE_SUFFIX):
+                        log.write("INFO IMPORT_DONE Imported file: %s\n" % f)
+
+
+########## PHASES ######################################
+
+class Phase:
+    def __init__(self, name, files, num_bytes, seconds, calls=None):
+        self.name = name
+        self.files = files
+        self.num_bytes = num_bytes
+        self.seconds = seconds
+        self.calls = calls or {}
+
+    def as_dict(self):
+        return {"phase": self.name, "files": self.files, "bytes": self.num_bytes, "seconds": self.seconds,
+                "files_per_s": self.files / self.seconds if self.seconds else None,
+                "mb_per_s": self.num_bytes / 1024 ** 2 / self.seconds if self.seconds else None,
+                "server_calls": {k: v for k, v in self.calls.items() if v}}
+
+
+def timed(name, func, files, num_bytes, conn=None):
+    before = dict(conn.calls) if conn else {}
+    start = time.perf_counter()
+    func()
+    seconds = time.perf_counter() - start
+    # calls of this phase, including the gateways of the session pool
+    calls = {k: v - before.get(k, 0) for k, v in conn.calls.items()} if conn else None
+    return Phase(name, files, num_bytes, seconds, calls)
+
+
+def run_phases(ri, fa, user_dir, work_dir, num_files, num_bytes, phases):
+    results = []
+    ri.DATA_PATH = os.path.join(work_dir, "data") + os.sep
+    fa.DATA_PATH = ri.DATA_PATH
+    ri.omero.cli.CLI = FakeCLI
+    ri.BlitzGateway = FakeGateway
+    ri.PROGRESS_INTERVAL = 3600
+    os.makedirs(ri.DATA_PATH, exist_ok=True)
+    attach_filter = ",".join(s.lstrip(".") for s in ATTACH_SUFFIXES)
+    stdout = sys.stdout
+
+    def quiet(func):
+        def run():
+            sys.stdout = open(os.devnull, "w")
+            try:
+                func()
+            finally:
+                sys.stdout.close()
+                sys.stdout = stdout
+        return run
+
+    if "scan" in phases:
+        conn = FakeGateway()
+        results.append(timed("getJobsAndTargets (project)", quiet(
+            lambda: ri.getJobsAndTargets(conn, user_dir + os.sep, "Project", 1, conn.project, WORKSTATION)),
+            num_files, 0, conn))
+
+    if "transfer" in phases:
+        conn = FakeGateway()
+        # the synthetic tree is on the same filesystem as DATA_PATH, measure the copy instead of reflinks
+        ri.STAGING_LINK_MODE = "copy"
+        results.append(timed("transfer_data", quiet(
+            lambda: ri.transfer_data(conn, user_dir, WORKSTATION)), num_files, num_bytes, conn))
+        results.append(timed("transfer_data (incremental, unchanged)", quiet(
+            lambda: ri.transfer_data(conn, user_dir, WORKSTATION, True)), num_files, 0, conn))
+
+        # tar stream instead of the copy threads, to choose BUNDLE_AVG_FILE_SIZE for a mount
+        bundle_settings = ri.BUNDLE_AVG_FILE_SIZE, ri.BUNDLE_MIN_FILES
+        ri.BUNDLE_AVG_FILE_SIZE, ri.BUNDLE_MIN_FILES = float("inf"), 1
+        try:
+            results.append(timed("transfer_data (bundled tar stream)", quiet(
+                lambda: ri.transfer_data(conn, user_dir, WORKSTATION)), num_files, num_bytes, conn))
+        finally:
+            ri.BUNDLE_AVG_FILE_SIZE, ri.BUNDLE_MIN_FILES = bundle_settings
+
+    if "reconcile" in phases:
+        imported = [os.path.join(r, n) for r, d, names in os.walk(user_dir) for n in names
+                    if n.endswith(IMAGE_SUFFIX)]
+        # every second image 'failed'
+        results.append(timed("validateImport/reconcileImport", quiet(
+            lambda: ri.validateImport([], imported[::2], user_dir, ri.DEPTH)), num_files, 0))
+
+    if "attach" in phases:
+        results.append(timed("getFilesByPattern", quiet(
+            lambda: ri.getFilesByPattern(ri.parseAttachFilter(attach_filter), user_dir, ri.DEPTH)), num_files, 0))
+        results.append(timed("getFilesByPattern (one pattern)", quiet(
+            lambda: ri.getFilesByPattern(["*" + ATTACH_SUFFIXES[0]], user_dir, ri.DEPTH)), num_files, 0))
+        conn = FakeGateway()
+        sessions = ri.SessionPool(conn.c, ri.ATTACH_SESSIONS)
+        results.append(timed("attachFiles", quiet(
+            lambda: ri.attachFiles(conn, 2, "Dataset", attach_filter, user_dir, WORKSTATION, ri.DEPTH, sessions)),
+            num_files, 0, conn))
+        sessions.close()
+
+    if "import" in phases:
+        conn = FakeGateway()
+        params = {ri.PARAM_WS: WORKSTATION, ri.PARAM_ATTACH: True, ri.PARAM_DEST_ATTACH: "Dataset",
+                  ri.PARAM_ATTACH_FILTER: attach_filter, ri.PARAM_SKIP_EXISTING: False}
+
+        def import_pipeline():
+            jobs, depth = ri.getJobsAndTargets(conn, user_dir + os.sep, "Project", 1, conn.project, WORKSTATION)
+            journal = ri.ImportJournal(os.path.join(work_dir, "journal.jsonl"), {"src": user_dir})
+            sessions = ri.SessionPool(conn.c, ri.IMPORT_JOBS + ri.ATTACH_SESSIONS)
+            try:
+                ri.importContent(conn, params, jobs, depth, sessions, journal)
+            finally:
+                sessions.close()
+                journal.finish()
+        results.append(timed("importContent (fake cli)", quiet(import_pipeline), num_files, num_bytes, conn))
+
+    if "fetch" in phases:
+        file_list = []
+        results.append(timed("FetchAndAttach.get_files", quiet(
+            lambda: file_list.extend(fa.get_files([s for s in ATTACH_SUFFIXES], user_dir))), num_files, 0))
+        fetch_bytes = sum(os.path.getsize(f) for f in file_list)
+        target = os.path.join(work_dir, "fetch")
+        results.append(timed("FetchAndAttach.copy_data", quiet(
+            lambda: fa.copy_data(file_list, user_dir, target)), len(file_list), fetch_bytes))
+
+    return results
+
+
+def print_report(results):
+    print("%-42s %9s %12s %10s %12s %10s" % ("phase", "files", "bytes", "seconds", "files/s", "MB/s"))
+    for r in results:
+        d = r.as_dict()
+        print("%-42s %9d %12d %10.3f %12s %10s" % (
+            d["phase"], d["files"], d["bytes"], d["seconds"],
+            "%.0f" % d["files_per_s"] if d["files_per_s"] else "-",
+            "%.1f" % d["mb_per_s"] if d["bytes"] and d["mb_per_s"] else "-"))
+        if d["server_calls"]:
+            print("%-42s server calls: %s" % ("", d["server_calls"]))
+
+
+def main():
+    all_phases = ["scan", "transfer", "reconcile", "attach", "import", "fetch"]
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--depth", type=int, default=2, help="directory levels below the user dir (default: 2)")
+    parser.add_argument("--fanout", type=int, default=4, help="subdirectories per directory (default: 4)")
+    parser.add_argument("--files", type=int, default=20, help="files per directory (default: 20)")
+    parser.add_argument("--size", default="256K", help="mean file size, e.g. 512K, 4M (default: 256K)")
+    parser.add_argument("--attach-share", type=float, default=0.2,
+                        help="share of non image (attachment) files (default: 0.2)")
+    parser.add_argument("--phases", default=",".join(all_phases),
+                        help="comma separated phases (default: %s)" % ",".join(all_phases))
+    parser.add_argument("--workdir", help="directory for the synthetic tree (default: temp dir, removed)")
+    parser.add_argument("--json", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    phases = [p.strip() for p in args.phases.split(",") if p.strip()]
+    work_dir = args.workdir or tempfile.mkdtemp(prefix="omero_import_bench_")
+    try:
+        ri = load_script("RemoteImport")
+        fa = load_script("FetchAndAttach")
+        start = time.perf_counter()
+        user_dir, num_files, num_bytes = generate_tree(os.path.join(work_dir, "mount"), args.depth, args.fanout,
+                                                       args.files, parse_size(args.size), args.attach_share)
+        print("Generated %d files (%.1f MB) in %.1f s under %s" % (
+            num_files, num_bytes / 1024 ** 2, time.perf_counter() - start, user_dir))
+        results = run_phases(ri, fa, user_dir, work_dir, num_files, num_bytes, phases)
+        print_report(results)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump({"config": vars(args), "files": num_files, "bytes": num_bytes,
+                           "results": [r.as_dict() for r in results]}, f, indent=2)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -23,6 +23,9 @@ from omero.gateway import BlitzGateway
 import datetime
 import os
 import shutil
+import threading
+import json
+import time
 
 ########## CONFIG #####################################
 MIMETYPE = 'zip/ptu'
@@ -36,6 +39,17 @@ DATA_PATH= "/storage/OMERO_inplace/users/"
 MOUNT_PATH = "/Importer/"
 # names of connected workstation devices
 WORKSTATION_NAMES = ["workstation1","workstation2"]
+# read budgets for the copy from a workstation: {name: [(start hour, end hour, bytes/s, read operations/s),..]},
+# None for unlimited; hours without rule and workstations without entry are unlimited, e.g.
+# "workstation1": [(7, 20, 50 * 1024 * 1024, 500)] limits the copy during working hours and is unlimited at night
+WORKSTATION_BUDGETS = {}
+# size of the chunks (bytes) read and written per copy call
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+# max. time (seconds) to wait for the automount of a workstation before it counts as offline
+PROBE_TIMEOUT = 5
+# workstation status cache shared with RemoteImport.py and its lifetime (seconds)
+PROBE_CACHE_PATH = os.path.join(DATA_PATH, "workstation_status.json")
+PROBE_CACHE_TTL = 60
 ########################################################
 
 PARAM_WS = "Workstations"
@@ -142,23 +156,76 @@ def identify_data(datapath: str, filter_list: list) -> list[str]:
 
 
 
-def check_workstations() -> list:
+OFFLINE = " offline"
+
+# os.path.isdir in a daemon thread, a hanging automount can not block the script
+# return True/False or None if there is no answer within timeout
+def probe_dir(path: str, timeout: float = PROBE_TIMEOUT):
     result = []
-    for w in WORKSTATION_NAMES:
-        srcPath = os.path.join(MOUNT_PATH,w)+os.sep
-        
-        if not os.path.isdir(srcPath):
-            result.append(f"{w} offline")
-        else:
-            result.append(w)
-    return result
+    probe = threading.Thread(target=lambda: result.append(os.path.isdir(path)), daemon=True)
+    probe.start()
+    probe.join(timeout)
+    return result[0] if result else None
+
+
+def load_probe_cache() -> dict:
+    try:
+        with open(PROBE_CACHE_PATH) as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+
+def save_probe_cache(cache: dict):
+    try:
+        tmp_path = f"{PROBE_CACHE_PATH}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, PROBE_CACHE_PATH)
+    except Exception as e:
+        print(f"WARN: can not write workstation status cache {PROBE_CACHE_PATH}: {str(e)}")
+
+
+# probe all workstations at the same time with PROBE_TIMEOUT,
+# cached states younger than PROBE_CACHE_TTL are used without probe if use_cache
+def probe_workstations(names: list, use_cache: bool = True) -> dict:
+    now = time.time()
+    cache = load_probe_cache()
+    status = {}
+    if use_cache:
+        for ws in names:
+            entry = cache.get(ws)
+            if entry is not None and now - entry["time"] < PROBE_CACHE_TTL:
+                status[ws] = entry["online"]
+
+    probes = {}
+    for ws in names:
+        if ws not in status:
+            result = []
+            path = os.path.join(MOUNT_PATH, ws) + os.sep
+            probes[ws] = (threading.Thread(target=lambda path=path, result=result: result.append(os.path.isdir(path)),
+                                           daemon=True), result)
+            probes[ws][0].start()
+    deadline = now + PROBE_TIMEOUT
+    for ws, (probe, result) in probes.items():
+        probe.join(max(deadline - time.time(), 0))
+        status[ws] = bool(result and result[0])
+        if not result:
+            print(f"WARN: no answer from {ws} within {PROBE_TIMEOUT} s")
+        cache[ws] = {"online": status[ws], "time": now}
+
+    if probes:
+        save_probe_cache(cache)
+    return status
+
+
+def check_workstations() -> list:
+    status = probe_workstations(WORKSTATION_NAMES)
+    return [w if status[w] else f"{w}{OFFLINE}" for w in WORKSTATION_NAMES]
             
 
 def check_workstation_is_online(ws):
-    if not os.path.isdir(os.path.join(MOUNT_PATH,ws)+os.sep):
-        return False
-    else:
-        return True
+    return probe_workstations([ws], use_cache=False)[ws]
 
 
 
@@ -167,7 +234,7 @@ def check_data_path(srcPath, userName):
         print("Mountpath: ", srcPath)
         dataPath = os.path.join(srcPath, userName) + os.sep
         
-        if not os.path.isdir(dataPath):
+        if not probe_dir(dataPath):
             sys.exit(f'ERROR: No data available on remote system for user: {userName}')
             return None
     
@@ -178,7 +245,75 @@ def check_data_path(srcPath, userName):
         sys.exit(f'ERROR: while reading mount dir: {str(e)}\n {exc_type} {exc_tb.tb_lineno}')
     return None
 
-def copy_data(file_list: list, source_folder: str, target_folder: str) -> list[str]:
+# (bytes/s, read operations/s) for the copy from workstation at the time now, None is unlimited
+def get_budget(workstation: str, now=None):
+    now = now or datetime.datetime.now()
+    hour = now.hour + now.minute / 60.0
+    for start, end, bytes_rate, ops_rate in WORKSTATION_BUDGETS.get(workstation, []):
+        if (start <= hour < end) if start <= end else (hour >= start or hour < end):
+            return bytes_rate, ops_rate
+    return None, None
+
+
+# token bucket with a burst of one second, consume() waits until the taken amount is covered by the rate
+class TokenBucket:
+    def __init__(self, rate=None):
+        self.rate = None
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        if rate != self.rate:
+            self.rate = rate
+            self.tokens = rate or 0
+            self.last = time.monotonic()
+
+    def consume(self, amount):
+        if not self.rate:
+            return
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= amount
+        if self.tokens < 0:
+            time.sleep(-self.tokens / self.rate)
+
+
+# bandwidth and read operation budget of the copy from one workstation (see WORKSTATION_BUDGETS),
+# the budget of the time of day is checked every UPDATE_INTERVAL seconds
+class WorkstationThrottle:
+    UPDATE_INTERVAL = 60
+
+    def __init__(self, workstation: str):
+        self.workstation = workstation
+        self.bytes = TokenBucket()
+        self.ops = TokenBucket()
+        self.next_update = 0
+
+    def consume(self, num_bytes: int, ops: int = 1):
+        now = time.monotonic()
+        if now >= self.next_update:
+            self.next_update = now + self.UPDATE_INTERVAL
+            bytes_rate, ops_rate = get_budget(self.workstation)
+            if (bytes_rate, ops_rate) != (self.bytes.rate, self.ops.rate):
+                print(f"Copy budget of {self.workstation}: {bytes_rate or 'unlimited'} bytes/s, "
+                      f"{ops_rate or 'unlimited'} read operations/s")
+            self.bytes.set_rate(bytes_rate)
+            self.ops.set_rate(ops_rate)
+        self.ops.consume(ops)
+        self.bytes.consume(num_bytes)
+
+
+def copy_file_throttled(src: Path, dst: Path, throttle: WorkstationThrottle):
+    throttle.consume(0)
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        for chunk in iter(lambda: fsrc.read(COPY_CHUNK_SIZE), b""):
+            throttle.consume(len(chunk))
+            fdst.write(chunk)
+    shutil.copystat(src, dst)
+
+
+def copy_data(file_list: list, source_folder: str, target_folder: str, workstation: str = None) -> list[str]:
+    throttle = WorkstationThrottle(workstation) if WORKSTATION_BUDGETS.get(workstation) else None
     target = Path(target_folder)
     source = Path(source_folder)
     path_list = []
@@ -195,7 +330,10 @@ def copy_data(file_list: list, source_folder: str, target_folder: str) -> list[s
         dst = Path.joinpath(target, relative)
         dst.parent.mkdir(parents=True, exist_ok=True)
         
-        shutil.copy2(src, dst)
+        if throttle is not None:
+            copy_file_throttled(src, dst, throttle)
+        else:
+            shutil.copy2(src, dst)
         path_list.append(dst)
   
     return path_list
@@ -215,7 +353,7 @@ def run_script():
         """,
         scripts.String(PARAM_WS, optional=False, grouping="1",
                        description="Choose a workstation that is NOT offline where you want to import from",
-                       values=WORKSTATION_NAMES),
+                       values=check_workstations()),
         scripts.String(PARAM_DATATYPE, optional=True, grouping="2",
                        description="Choose kind of destination object.",
                        values=dataTypes),
@@ -234,6 +372,10 @@ def run_script():
         params = client.getInputs(unwrap=True)
         if os.path.exists(MOUNT_PATH):
             ws = params.get(PARAM_WS)
+            if ws.endswith(OFFLINE):
+                # state of the selection may be outdated, the workstation is probed again
+                ws = ws[:-len(OFFLINE)]
+                params[PARAM_WS] = ws
             if check_workstation_is_online(ws):
                 conn = BlitzGateway(client_obj=client)
                 data_src_path = check_data_path(os.path.join(MOUNT_PATH,ws)+os.sep,conn.getUser().getName())
@@ -242,7 +384,7 @@ def run_script():
                     data_list = identify_data(data_src_path, filter_list)
                     dest = create_new_repo_path(conn.getUser().getName(), conn.getUser().getId())
                     print("Copy data to: ",dest)
-                    data_path_list = copy_data(data_list, data_src_path, dest)
+                    data_path_list = copy_data(data_list, data_src_path, dest, ws)
                     target = f"{params.get(PARAM_DATATYPE)}:{params.get(PARAM_ID)}"
                     robj = None
                     message = "Data attached"
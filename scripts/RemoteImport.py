@@ -9,7 +9,8 @@ Appends non-image files with specified suffixes to project or dataset.
 Possible configurations:
 * INPLACE_IMPORT = true: use inplace import instead of normal import
 * COPY_SOURCES = true: creates  directories in DATA_PATH like <username>_<userID>/yyyy-MM/dd/HH-mm-ss.SSS/
- and transfer data before import to this target
+ and transfer data before import to this target. With "Skip already imported files" only new or changed files
+ (see transfer manifest in DATA_PATH/<username>_<userID>/) are transferred and imported
 
 Usage:
 Select PROJECT as TARGET for import :
@@ -52,10 +53,23 @@ import time
 import tempfile
 from pathlib import Path
 import threading
+import queue
+import fcntl
+import contextlib
+import uuid
+from collections import Counter
+import signal
 import datetime
-import glob
+import json
+import hashlib
 import shutil
-from concurrent.futures import ProcessPoolExecutor
+import fnmatch
+import bisect
+import select
+import struct
+import ctypes
+import tarfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 
 ############### CONFIGURATIONS ######################################
@@ -67,10 +81,93 @@ DATA_PATH= "/storage/OMERO_inplace/users/"
 INPLACE_IMPORT = True
 # enable/disable transfer of data to directory specified under DATA_PATH
 COPY_SOURCES = True
+# number of parallel copy threads used for the transfer to DATA_PATH
+COPY_WORKERS = 8
+# files larger than this size (bytes) are copied kernel-side (copy_file_range/sendfile)
+LARGE_FILE_SIZE = 64 * 1024 * 1024
+# size of the chunks (bytes) read and written per copy call
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+# compare content hash (sha1) in transfer manifest for files with changed mtime but same size
+MANIFEST_HASH = False
+# compute the sha1 (the checksum of omero import) while copying and verify the copy against the source stat,
+# the checksums are written to CHECKSUM_FILE in the destination directory (sha1sum format)
+COPY_VERIFY = True
+CHECKSUM_FILE = ".checksums.sha1"
+# transfers of at least BUNDLE_MIN_FILES files with an average size below BUNDLE_AVG_FILE_SIZE (bytes)
+# are read by tar as one sequential stream and unpacked on the server (0: never).
+# tar runs on the server and reads the files one after another over the mount, so measure with
+# benchmarks/benchmark_remote_import.py on the real mount before enabling it
+BUNDLE_AVG_FILE_SIZE = 0
+BUNDLE_MIN_FILES = 1000
+# let omero import use the file size instead of reading the verified copies again for the sha1,
+# only for jobs whose files all have a checksum in CHECKSUM_FILE; OMERO then stores the file size
+# instead of the sha1 of the imported files
+IMPORT_VERIFIED_CHECKSUM = False
+# staging if source and DATA_PATH are on the same filesystem: "reflink" (copy-on-write clone, falls back to copy),
+# "hardlink" (shares the inode: later changes of the source also change the imported file) or "copy"
+STAGING_LINK_MODE = "reflink"
+# keep each unique file content once in a content-addressed store (DEDUP_STORE_PATH/<sha1[:2]>/<sha1>),
+# the per-run directories under DATA_PATH are hardlinks into the store (must be on the same filesystem)
+DEDUP_STORE = False
+DEDUP_STORE_PATH = os.path.join(DATA_PATH,".cas")
+# number of dataset import jobs (cli imports incl. validation, attachment and retry) running at the same time
+IMPORT_JOBS = 3
+# upper limits for the filesets / uploads of all IMPORT_JOBS together, each job gets an equal share
+# as limit for --parallel-fileset / --parallel-upload, the values are chosen per job from the file profile
+PARALLEL_FILESET_MAX = 8
+PARALLEL_UPLOAD_MAX = 8
+# files smaller than this size (bytes) count as small files, files larger than LARGE_IMPORT_SIZE as large files
+SMALL_FILE_SIZE = 16 * 1024 * 1024
+LARGE_IMPORT_SIZE = 2 * 1024 * 1024 * 1024
+# number of parallel directory scans of the dry run planner
+PLAN_SCAN_WORKERS = 8
+# max. number of files retried by one cli import call
+RETRY_BATCH_SIZE = 200
+# number of parallel attachment uploads
+ATTACH_WORKERS = 4
+# number of additional sessions shared by the attachment upload threads
+ATTACH_SESSIONS = 2
+# number of annotation links saved in one call
+ATTACH_LINK_BATCH = 100
+# interval (seconds) of the progress report of a running import
+PROGRESS_INTERVAL = 60
+# stop a running import if the rate of failed files exceeds this value, e.g. 0.5 (None: never stop)
+MAX_FAILURE_RATE = None
+# minimum number of processed files before the failure rate is checked
+MIN_FILES_FAILURE_RATE = 20
+# lines of the import log that mark a failed file
+FAILURE_MARKERS = ["FILE_EXCEPTION","INTERNAL_EXCEPTION","UNKNOWN_FORMAT"]
+# enable/disable the shared import queue (fair scheduling of the runs of all users and workstations)
+IMPORT_QUEUE = False
+# directory of the shared import queue
+QUEUE_PATH = "/storage/OMERO_inplace/queue/"
+# max. number of running imports per workstation, per user and in total
+QUEUE_LIMIT_WORKSTATION = 1
+QUEUE_LIMIT_USER = 1
+QUEUE_LIMIT_TOTAL = 4
+# interval (seconds) to check the position in the queue
+QUEUE_POLL = 30
+# watch mode: interval (seconds) to check the import folder for new files
+# and time (seconds) a new file must be unchanged before it is imported
+WATCH_POLL = 30
+WATCH_SETTLE = 120
+# max. duration (minutes) of the watch mode
+WATCH_MAX_DURATION = 12 * 60
+# filesystem types without inotify events for changes on the remote side, these mounts are polled
+POLL_FILESYSTEMS = ("nfs","nfs4","cifs","smb3","smbfs","fuse.sshfs","autofs")
 # main directory of mount points
 MOUNT_PATH = "/Importer/"
 # mount point names/ workstations
 WORKSTATION_NAMES=["cn-imaris","cn-lattice","cn-airyscan"]
+# read budgets for the copy from a workstation: {name: [(start hour, end hour, bytes/s, read operations/s),..]},
+# None for unlimited; hours without rule and workstations without entry are unlimited, e.g.
+# "cn-imaris": [(7, 20, 50 * 1024 * 1024, 500)] limits the copy during working hours and is unlimited at night
+WORKSTATION_BUDGETS = {}
+# max. time (seconds) to wait for the automount of a workstation before it counts as offline
+PROBE_TIMEOUT = 5
+# workstation status cache shared with FetchAndAttach.py and its lifetime (seconds)
+PROBE_CACHE_PATH = os.path.join(DATA_PATH,"workstation_status.json")
+PROBE_CACHE_TTL = 60
 
 #####################################################################
 
@@ -81,8 +178,12 @@ PARAM_ATTACH = "Attach non image files"
 PARAM_DEST_ATTACH = "Attach to object type"
 PARAM_ATTACH_FILTER = "Filter attachment by extension"
 PARAM_SKIP_EXISTING = "Skip already imported files"
+PARAM_DRY_RUN = "Dry run"
+PARAM_WATCH = "Watch (minutes)"
 
 IDLETIME = 5
+# max. time (seconds) to wait for a session to answer
+READY_TIMEOUT = IDLETIME * 6
 
 
 def get_formated_date():
@@ -93,29 +194,107 @@ def get_formated_date():
 
     return year_m,day,time
 
+# user directory: DATA_PATH/<username>_<userID>/
+def get_user_repo_path(conn):
+    return os.path.join(DATA_PATH,"%s_%s"%(conn.getUser().getName(),conn.getUser().getId()))
+
 # creates directories: <username>_<userID>/yyyy-MM/dd/HH-mm-ss.SSS/
 def create_new_repo_path(conn):
-    p1= "%s_%s"%(conn.getUser().getName(),conn.getUser().getId())
     p2,p3,p4=get_formated_date()
-    repo_path=os.path.join(DATA_PATH, os.path.join(os.path.join(os.path.join(p1, p2), p3), p4))
+    repo_path=os.path.join(get_user_repo_path(conn), os.path.join(os.path.join(p2, p3), p4))
     print(repo_path)
     os.makedirs(repo_path, exist_ok=True)
     return repo_path
 
-def createDataset(conn,pID,dName):
-    # create dataset for experiment dir
-    dataset = omero.model.DatasetI()
-    dataset.name = rstring(dName)
-    dataset = conn.getUpdateService().saveAndReturnObject(dataset)
-    # link to project
-    link = omero.model.ProjectDatasetLinkI()
-    link.setParent(omero.model.ProjectI(pID, False))
-    link.setChild(dataset)
-    conn.getUpdateService().saveObject(link)
-    datasetID = dataset.getId().getValue()
-    print("\t* Create Dataset with name %s -- ID: %d"%(dName,datasetID))
-
-    return datasetID
+# timing spans of the phases and jobs of a run with bytes and file counts,
+# written as JSON report and attached to the import target
+class RunReport:
+    def __init__(self,info):
+        self.info = info
+        self.spans = []
+        self.startTime = time.time()
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self,phase,job=None,**counts):
+        record = {"phase":phase,"job":job,"bytes":0,"files":0}
+        record.update(counts)
+        start = time.time()
+        try:
+            yield record
+        finally:
+            record["start"] = round(start - self.startTime,3)
+            record["seconds"] = round(time.time() - start,3)
+            with self.lock:
+                self.spans.append(record)
+
+    # sum of seconds, bytes and files per phase
+    def summary(self):
+        phases = {}
+        for record in self.spans:
+            total = phases.setdefault(record["phase"],{"seconds":0,"bytes":0,"files":0,"count":0})
+            total["seconds"] = round(total["seconds"] + record["seconds"],3)
+            total["bytes"] += record["bytes"]
+            total["files"] += record["files"]
+            total["count"] += 1
+        return phases
+
+    def toJSON(self):
+        report = dict(self.info)
+        report["seconds"] = round(time.time() - self.startTime,3)
+        report["phases"] = self.summary()
+        report["spans"] = self.spans
+        return json.dumps(report,indent=1)
+
+    def printSummary(self):
+        print("Run report:")
+        for phase,total in self.summary().items():
+            print("\t%-18s %8.1f s %8d files %10s (%d spans)"%(phase,total["seconds"],total["files"],
+                                                              formatBytes(total["bytes"]),total["count"]))
+
+    # attach the JSON report to obj like the import log
+    def attach(self,conn,obj,namespace):
+        with tempfile.NamedTemporaryFile(mode="w",prefix="import_report_",suffix=".json") as reportFile:
+            reportFile.write(self.toJSON())
+            reportFile.flush()
+            ann = conn.createFileAnnfromLocalFile(reportFile.name,mimetype="application/json",ns=namespace+"_report")
+            obj.linkAnnotation(ann)
+
+
+# report of the current run (set by remoteImport)
+runReport = None
+
+def span(phase,job=None,**counts):
+    if runReport is None:
+        record = {"phase":phase,"job":job,"bytes":0,"files":0}
+        record.update(counts)
+        return contextlib.nullcontext(record)
+    return runReport.span(phase,job,**counts)
+
+
+# create datasets for experiment dirs together with the links to the project in one call
+# return {datasetName: datasetID}
+def createDatasets(conn,pID,dNames):
+    if len(dNames) == 0:
+        return {}
+    links = []
+    for dName in dNames:
+        dataset = omero.model.DatasetI()
+        dataset.name = rstring(dName)
+        link = omero.model.ProjectDatasetLinkI()
+        link.setParent(omero.model.ProjectI(pID, False))
+        link.setChild(dataset)
+        links.append(link)
+    links = conn.getUpdateService().saveAndReturnArray(links)
+
+    datasetIDs = {}
+    for link in links:
+        dataset = link.getChild()
+        dName = unwrap(dataset.getName())
+        datasetIDs[dName] = dataset.getId().getValue()
+        print("\t* Create Dataset with name %s -- ID: %d"%(dName,datasetIDs[dName]))
+
+    return datasetIDs
 
 
 def getImportTarget(conn,params):
@@ -139,7 +318,40 @@ def getImportTarget(conn,params):
     return destID,destObj,destType
 
 
-def createArgumentList(ipath,id,skip,depth):
+# True if all files of ipath (directory down to depth or list of files) have a checksum
+# in the CHECKSUM_FILE of their staging directory (not for linked files)
+def isVerifiedCopy(ipath,depth):
+    paths = [ipath] if isinstance(ipath,str) else ipath
+    files = []
+    for path in paths:
+        path = os.path.realpath(path.replace("\\ "," "))
+        if os.path.isdir(path):
+            files.extend(entry.path for entry in walkFiles(path,depth))
+        else:
+            files.append(path)
+    if len(files) == 0:
+        return False
+
+    checksums = {}
+    for f in files:
+        # staging directory: first parent with a checksum file
+        root = os.path.dirname(f)
+        while not os.path.isfile(os.path.join(root,CHECKSUM_FILE)):
+            parent = os.path.dirname(root)
+            if parent == root:
+                return False
+            root = parent
+        if root not in checksums:
+            checksums[root] = loadChecksums(root)
+        if os.path.relpath(f,root) not in checksums[root]:
+            return False
+    return True
+
+
+# ipath: source directory or list of source files
+# parallel: (--parallel-fileset, --parallel-upload)
+# resumed: exclude the files imported by the interrupted run from the same staging directory
+def createArgumentList(ipath,id,skip,depth,parallel=(2,2),resumed=False):
     import_args =["import"]
     import_args.extend(['-c']) # continue if errors
     # TODO: skip for screendata and rename the created screen folder in omero like the given projectfolder's name?
@@ -147,39 +359,132 @@ def createArgumentList(ipath,id,skip,depth):
         import_args.extend(['--transfer=ln_s'])
 
     import_args.extend(['-d',str(id)])
-    import_args.extend(['--parallel-fileset','2'])
-    import_args.extend(['--parallel-upload','2'])
+    import_args.extend(['--parallel-fileset',str(parallel[0])])
+    import_args.extend(['--parallel-upload',str(parallel[1])])
     import_args.extend(['--no-upgrade-check'])
     import_args.extend(['--depth',str(depth)])
-    if skip and not COPY_SOURCES:
+    if (skip and not COPY_SOURCES) or resumed:
         import_args.extend(["--exclude=clientpath"])
+    if COPY_SOURCES and COPY_VERIFY and IMPORT_VERIFIED_CHECKSUM and isVerifiedCopy(ipath,depth):
+        # content was checksummed and verified by the copy
+        import_args.extend(["--checksum-algorithm=File-Size-64"])
 
-    import_args.extend([Path(ipath).resolve().as_posix().replace("\ "," ")])
+    if isinstance(ipath,str):
+        ipath = [ipath]
+    import_args.extend([Path(p).resolve().as_posix().replace("\ "," ") for p in ipath])
 
     return import_args
 
 
 
 
-def parseLogFile(stderr):
+PARSE_IMPORTED = "IMPORT_DONE Imported file:"
+PARSE_SKIPPED = "ClientPath match for filename:"
+
 
-    parseStr0 = "IMPORT_DONE Imported file:"
-    parseStr1 = "ClientPath match for filename:"
-    images_skipped=[]
-    image_imported=[]
-    index =0
+# return ("imported"|"skipped"|"failed", path) or (None, None) for one line of the import log
+def parseLogLine(line):
+    if PARSE_IMPORTED in line:
+        return "imported",line[line.find(PARSE_IMPORTED)+len(PARSE_IMPORTED):].strip()
+    if PARSE_SKIPPED in line:
+        return "skipped",line[line.find(PARSE_SKIPPED)+len(PARSE_SKIPPED):].strip()
+    for marker in FAILURE_MARKERS:
+        if marker in line:
+            # "<marker>: <path>", one failed file can log several lines
+            p = line[line.find(marker)+len(marker):].strip().lstrip(":").strip()
+            return "failed",p or line.strip()
+    return None,None
 
-    with open(stderr.name) as inFile:
-        for line in inFile:
-            if parseStr0 in line:
-                p=(line[line.find(parseStr0)+len(parseStr0):len(line)]).strip()
-                image_imported.append(p)
-            if parseStr1 in line:
-                p=(line[line.find(parseStr1)+len(parseStr1):len(line)]).strip()
-                images_skipped.append(p)
-            index=index+1
 
-    return images_skipped,image_imported
+# send SIGTERM to the import process that writes its stderr to logPath
+def stopImportProcess(logPath):
+    logPath = os.path.realpath(logPath)
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit() or int(pid) == os.getpid():
+            continue
+        try:
+            if os.readlink("/proc/%s/fd/2"%pid) == logPath:
+                print("Stop import process %s"%pid)
+                os.kill(int(pid),signal.SIGTERM)
+        except OSError:
+            continue
+
+
+# reads the import log while the import is running:
+# counts imported, skipped and failed files, reports progress and throughput every PROGRESS_INTERVAL
+# and stops the import if the failure rate exceeds MAX_FAILURE_RATE
+class ImportLogTail(threading.Thread):
+    def __init__(self,logPath,label,journal=None):
+        threading.Thread.__init__(self,daemon=True)
+        self.logPath = logPath
+        self.label = label
+        self.journal = journal
+        self.images_imported = []
+        self.images_skipped = []
+        self.images_failed = set()
+        self.importedBytes = 0
+        self.aborted = False
+        self.startTime = time.time()
+        self.finished = threading.Event()
+
+    def failureRate(self):
+        numFiles = len(self.images_imported) + len(self.images_skipped) + len(self.images_failed)
+        if numFiles < MIN_FILES_FAILURE_RATE:
+            return 0
+        return len(self.images_failed) / numFiles
+
+    def report(self):
+        duration = max(time.time() - self.startTime,0.001)
+        print("Progress %s: imported %d, skipped %d, failed %d (%.1f files/min, %s/s)"%(
+            self.label,len(self.images_imported),len(self.images_skipped),len(self.images_failed),
+            len(self.images_imported)*60/duration,formatBytes(self.importedBytes/duration)),flush=True)
+
+    def parse(self,line):
+        kind,p = parseLogLine(line)
+        if self.journal is not None and kind in ("imported","skipped"):
+            self.journal.fileDone(p,kind)
+        if kind == "imported":
+            self.images_imported.append(p)
+            try:
+                self.importedBytes += os.path.getsize(p)
+            except OSError:
+                pass
+        elif kind == "skipped":
+            self.images_skipped.append(p)
+        elif kind == "failed" and p not in self.images_failed:
+            self.images_failed.add(p)
+            if MAX_FAILURE_RATE is not None and not self.aborted and self.failureRate() > MAX_FAILURE_RATE:
+                print("ERROR: failure rate %.2f of %s exceeds %.2f, stop import"%(
+                    self.failureRate(),self.label,MAX_FAILURE_RATE))
+                self.aborted = True
+                stopImportProcess(self.logPath)
+
+    def run(self):
+        lastReport = time.time()
+        buffer = ""
+        with open(self.logPath) as inFile:
+            while True:
+                data = inFile.read()
+                if data:
+                    lines = (buffer + data).split("\n")
+                    buffer = lines.pop()
+                    for line in lines:
+                        self.parse(line)
+                elif self.finished.is_set():
+                    break
+                else:
+                    self.finished.wait(0.5)
+                if time.time() - lastReport > PROGRESS_INTERVAL:
+                    self.report()
+                    lastReport = time.time()
+        if buffer:
+            self.parse(buffer)
+
+    # import has returned: read the rest of the log and wait for the end of the thread
+    def finish(self):
+        self.finished.set()
+        self.join()
+        self.report()
 
 
 # this function assume that minimum one image file was imported
@@ -187,75 +492,241 @@ def parseLogFile(stderr):
 # return
 # 1. list of files for newly import (kind of this files was still imported)
 # 2. list of other files (non image file format or not yet imported kind of file suffixes)
-def validateImport(images_skipped,images_imported,ipath):
-
-    # not_imported = image and non image file formats
-    not_imported,suffixes = filterNotImported(images_skipped,images_imported,ipath)
-
-    print("Not Imported: ",len(not_imported))
-    print("Suffixes of nt imported: ",suffixes)
-
-    newly_importList=[]
-    other_fList=[]
-    for f in not_imported:
-        suffix = Path(f).suffix
-        if suffix in suffixes:
-            newly_importList.append("/"+f)
-        else:
-            other_fList.append(f)
-
-    print ("Newly import files: ",len(newly_importList))
-    print ("Other files: ",len(other_fList))
-
-    return newly_importList,other_fList
-
-
-# return
-# 1. list of files that are not in the list of image_imported as well as in the skipped list,
-#       but available in the imported source directory
-# 2. list of imported or skipped file suffixes
-def filterNotImported(images_skipped,image_imported,path):
-    not_imported = []
-    suffixes=[]
-
-    filePaths=glob.iglob("%s/*.*"%path,recursive=False)
-
-    for f in filePaths:
-        if f.strip() not in image_imported:
-            #print("\t [%s] is not in imported "%(f))
-            if f.strip() not in images_skipped:
-                #print("\t [%s] is not in skipped "%(f))
-                not_imported.append(f)
-            else:
-                suffixes.append(Path(f).suffix)
-        else:
-            suffixes.append(Path(f).suffix)
-
-    return not_imported,suffixes
-
-
-def getFiles(pattern,dir,depth):
-    result=[]
-
-    if depth > 1:
-        files=list(Path(dir).rglob(pattern))
+def validateImport(images_skipped,images_imported,ipath,depth,filesets=None,paths=None):
+    report = reconcileImport(images_skipped,images_imported,ipath,depth,filesets,paths)
+
+    print("Reconcile %s: imported %d, skipped %d, in imported filesets %d, retriable %d, non image %d"%(
+        ipath,len(report["imported"]),len(report["skipped"]),len(report["fileset"]),len(report["retriable"]),
+        len(report["nonImage"])))
+
+    return report["retriable"],report["nonImage"]
+
+
+# number of files, total size, number of small and number of large files below ipath down to depth,
+# number of files matching the attachment patterns, the candidate filesets (see classifyFilesets)
+# and the paths of the files (reused by the validation and attachment of the job)
+def profileJob(ipath,depth,patterns=()):
+    profile = {"files":0,"bytes":0,"small":0,"large":0,"attachments":0}
+    paths = []
+    for entry in walkFiles(os.path.realpath(ipath.replace("\\ "," ")),depth):
+        paths.append(entry.path)
+        if any(fnmatch.fnmatchcase(entry.name,pattern) for pattern in patterns):
+            profile["attachments"] += 1
+        size = entry.stat().st_size
+        profile["files"] += 1
+        profile["bytes"] += size
+        if size < SMALL_FILE_SIZE:
+            profile["small"] += 1
+        elif size > LARGE_IMPORT_SIZE:
+            profile["large"] += 1
+    profile["filesets"] = classifyFilesets(paths)
+    profile["paths"] = paths
+    return profile
+
+
+# multi-file formats: (suffix of the fileset leader, patterns of the members relative to the leader's directory)
+# {base} is the leader name without suffix, patterns with "/" match the files in the subdirectory at any depth
+FILESET_RULES = [
+    (".companion.ome", ["*.ome.tif","*.ome.tiff"]),  # OME-TIFF with companion file
+    (".ome.xml", ["*.ome.tif","*.ome.tiff"]),
+    (".vsi", ["_{base}_/*"]),  # Olympus cellSens, .ets in _name_/stackN/
+    (".mrxs", ["{base}/*"]),  # 3DHistech, Data*.dat and Slidedat.ini in name/
+    (".nd", ["{base}_*.stk","{base}_*.tif","{base}_*.TIF"]),  # MetaMorph
+    (".czi", ["{base}(*).czi"]),  # Zeiss multi-part czi
+    (".xdce", ["*.tif","*.tiff"]),  # GE InCell
+    (".ics", ["{base}.ids"]),
+    (".hdr", ["{base}.img"]),  # Analyze
+    (".dv", ["{base}.dv.log"]),  # DeltaVision
+]
+
+# suffixes of files that are never imported as images
+NON_IMAGE_SUFFIXES = (".txt",".pdf",".doc",".docx",".xls",".xlsx",".csv",".pptx",".md",".rtf",".json",
+                      ".zip",".py",".m",".ijm",".html",".log")
+
+
+def escapePattern(name):
+    return "".join("[%s]"%c if c in "*?[" else c for c in name)
+
+
+# group the files into candidate filesets of the known multi-file formats
+# return {"leaders": {leader: [members]}, "members": {member: leader}, "nonImage": set of known non image files}
+def classifyFilesets(paths):
+    paths = sorted(paths)
+    byDir = {}
+    for path in paths:
+        byDir.setdefault(os.path.dirname(path),[]).append(path)
+
+    candidates = {}
+    for path in paths:
+        name = os.path.basename(path)
+        for suffix,patterns in FILESET_RULES:
+            if not name.lower().endswith(suffix):
+                continue
+            base = name[:-len(suffix)]
+            leaderDir = os.path.dirname(path)
+            members = []
+            for pattern in patterns:
+                if "/" in pattern:
+                    # all files below the subdirectory
+                    subdir = os.path.join(leaderDir,pattern.split("/")[0].format(base=base))
+                    start = bisect.bisect_left(paths,subdir + os.sep)
+                    for member in paths[start:]:
+                        if not member.startswith(subdir + os.sep):
+                            break
+                        members.append(member)
+                else:
+                    pattern = pattern.format(base=escapePattern(base))
+                    members.extend(member for member in byDir[leaderDir]
+                                   if member != path and fnmatch.fnmatchcase(os.path.basename(member),pattern))
+            candidates[path] = members
+            break
+
+    filesets = {"leaders":{},"members":{},"nonImage":set()}
+    for leader,members in candidates.items():
+        for member in members:
+            filesets["members"].setdefault(member,leader)
+    for leader,members in candidates.items():
+        # a part of another fileset (e.g. name(1).czi of name.czi) is no leader
+        if leader not in filesets["members"]:
+            filesets["leaders"][leader] = [m for m in members if filesets["members"][m] == leader]
+    filesets["members"] = {m:l for m,l in filesets["members"].items() if l in filesets["leaders"]}
+    for path in paths:
+        if path not in filesets["members"] and path.lower().endswith(NON_IMAGE_SUFFIXES):
+            filesets["nonImage"].add(path)
+    return filesets
+
+
+# per job limits for --parallel-fileset / --parallel-upload: share of one of the IMPORT_JOBS parallel jobs
+def getParallelLimits():
+    return max(PARALLEL_FILESET_MAX // IMPORT_JOBS,1),max(PARALLEL_UPLOAD_MAX // IMPORT_JOBS,1)
+
+
+# choose --parallel-fileset and --parallel-upload for the job profile within the per job limits
+# (small files >= mixed >= large files), return (fileset, upload) and the reason of the choice
+def chooseParallelism(profile,inplace):
+    numFiles = profile["files"]
+    if numFiles <= 1:
+        return (1,1),"single file"
+    filesetMax,uploadMax = getParallelLimits()
+    if profile["large"] * 2 >= numFiles:
+        # every fileset keeps the server busy for a long time
+        fileset = max(filesetMax // 4,1)
+        reason = "mostly large files (%d of %d)"%(profile["large"],numFiles)
+    elif profile["small"] * 2 >= numFiles:
+        fileset = filesetMax
+        reason = "mostly small files (%d of %d)"%(profile["small"],numFiles)
     else:
-        files=list(Path(dir).glob(pattern))
-    for file in files:
-        result.append(file.resolve().as_posix())
-
-    if len(result)==0:
-        return None
-
+        fileset = max(filesetMax // 2,1)
+        reason = "mixed file sizes"
+    if inplace:
+        # ln_s only creates links
+        upload = uploadMax
+        reason = reason + ", in-place import"
+    elif profile["large"] * 2 >= numFiles:
+        # bandwidth bound
+        upload = max(uploadMax // 2,1)
+        reason = reason + ", upload of large files"
+    else:
+        upload = uploadMax
+        reason = reason + ", upload"
+    return (min(fileset,filesetMax,numFiles),min(upload,uploadMax,numFiles)),reason
+
+
+# files below path down to depth directory levels (depth 1: only the files in path), without hidden files
+def walkFiles(path,depth):
+    stack=[(path,1)]
+    while stack:
+        currentdir,level = stack.pop()
+        with os.scandir(currentdir) as it:
+            for entry in it:
+                if entry.name.startswith("."):
+                    continue
+                if entry.is_dir():
+                    if level < depth:
+                        stack.append((entry.path,level+1))
+                elif entry.is_file():
+                    yield entry
+
+
+# compare the files in the import directory (down to depth) with the import log
+# return {"imported":[..],"skipped":[..],"fileset":[..],"retriable":[..],"nonImage":[..]}
+# fileset: files of a fileset (see classifyFilesets) that is imported or skipped, or members of a retriable leader
+# retriable: not imported fileset leaders and other files with the suffix of an imported or skipped file
+# paths: files of the import directory if already known (see profileJob)
+def reconcileImport(images_skipped,image_imported,path,depth,filesets=None,paths=None):
+    imported = {os.path.normpath(f) for f in image_imported}
+    skipped = {os.path.normpath(f) for f in images_skipped}
+    suffixes = {os.path.splitext(f)[1] for f in imported | skipped}
+
+    if paths is None:
+        root = os.path.realpath(path.replace("\\ "," "))
+        paths = [entry.path for entry in walkFiles(root,depth)]
+    if filesets is None:
+        filesets = classifyFilesets(paths)
+    leaders = filesets["leaders"]
+    members = filesets["members"]
+    # leaders of filesets with any file in the import log
+    done = {members.get(f,f) for f in imported | skipped}
+
+    report = {"imported":[],"skipped":[],"fileset":[],"retriable":[],"nonImage":[]}
+    for path in paths:
+        if path in imported:
+            report["imported"].append(path)
+        elif path in skipped:
+            report["skipped"].append(path)
+        elif path in members or (path in leaders and path in done):
+            report["fileset"].append(path)
+        elif path in leaders:
+            report["retriable"].append(path)
+        elif path in filesets["nonImage"]:
+            report["nonImage"].append(path)
+        elif os.path.splitext(path)[1] in suffixes:
+            report["retriable"].append(path)
+        else:
+            report["nonImage"].append(path)
+
+    return report
+
+
+# one walk over dir (down to depth) that matches all patterns, every file is assigned to the first matching pattern
+# paths: files of dir if already known (no walk)
+# return {pattern: [files]}
+def getFilesByPattern(patterns,dir,depth,paths=None):
+    result = {pattern:[] for pattern in patterns}
+    if paths is None:
+        paths = (entry.path for entry in walkFiles(os.path.realpath(dir.replace("\\ "," ")),depth))
+    for path in paths:
+        name = os.path.basename(path)
+        for pattern in patterns:
+            if fnmatch.fnmatchcase(name,pattern):
+                result[pattern].append(path)
+                break
     return result
 
 
-def attachFiles(conn, destID, destType,values,srcPath,namespace,depth):
+# file name patterns of the comma separated extension filter, e.g. "txt, pdf" -> ["*.txt","*.pdf"]
+def parseAttachFilter(values):
+    patterns = []
+    for extensionPattern in values.split(","):
+        extensionPattern = extensionPattern.strip()
+        if len(extensionPattern) > 0:
+            if not "." in extensionPattern:
+                extensionPattern = "." + extensionPattern
+            if not "*" in extensionPattern:
+                extensionPattern = "*" + extensionPattern
+            print("\t* attachments filter by pattern %s"%(extensionPattern))
+            patterns.append(extensionPattern)
+    return patterns
+
+
+# without filter (values) the known non image files (nonImage) are attached
+# paths: files of srcPath if already known (see profileJob)
+# return number of attached files
+def attachFiles(conn, destID, destType,values,srcPath,namespace,depth,sessions,nonImage=None,paths=None):
     try:
-        if len(values)==0:
+        if not values and not nonImage:
             print ("\t WARN: No extension filter specified! No files will be attached.")
-            return
-        extFilters = values.split(",")
+            return 0
         destObj = None
         if destType == 'Dataset':
             destObj = conn.getObject("Dataset", destID)
@@ -265,56 +736,191 @@ def attachFiles(conn, destID, destType,values,srcPath,namespace,depth):
 
         if destObj is None:
             print("ERROR attach files: can not attach files to object: None")
-            return
-
-        for extensionPattern in extFilters:
-            extensionPattern.replace(" ", "")
-            if len(extensionPattern) > 0:
-                if not "." in extensionPattern:
-                    extensionPattern = "." + extensionPattern
-                if not "*" in extensionPattern:
-                    extensionPattern = "*" + extensionPattern
-                print("\t* attachments filter by pattern %s"%(extensionPattern))
-
-                res=getFiles(extensionPattern,srcPath,depth)
-                print("Found: ",list(res))
-                if res is not None:
-                    for attachFile in res:
-                        print("\tATTACH File %s to %s "%(attachFile,str(destObj)))
-                        if attachFile is not None:
-                            file_ann = conn.createFileAnnfromLocalFile(attachFile, mimetype="text/plain",
-                                                                       ns=namespace,
-                                                                       desc=None)
-                            #print "*** ATTACHING FileAnnotation to Dataset: ", "File ID:", file_ann.getId(), \
-                            #      ",", file_ann.getFile().getName(), "Size:", file_ann.getFile().getSize()
-                            destObj.linkAnnotation(file_ann)  # link to src file
-                else:
-                    print("\t=> no file found for pattern %s"% (extensionPattern))
+            return 0
+
+        if not values:
+            print("No extension filter specified, attach %d known non image files"%len(nonImage))
+            values = ""
+        patterns = parseAttachFilter(values)
+        found = getFilesByPattern(patterns,srcPath,depth,paths)
+        attachList = [] if patterns else list(nonImage)
+        for extensionPattern in patterns:
+            res = found[extensionPattern]
+            print("Found for pattern %s: %d files"%(extensionPattern,len(res)))
+            if len(res) == 0:
+                print("\t=> no file found for pattern %s"% (extensionPattern))
+            attachList.extend(res)
+
+        failed = uploadAttachments(conn,destObj,attachList,namespace,sessions)
+        if len(failed) > 0:
+            print("ERROR attach files: %d of %d files not attached:"%(len(failed),len(attachList)))
+            print('\n'.join(failed))
+        return len(attachList) - len(failed)
 
     except Exception as e:
         exc_type, exc_obj, exc_tb = sys.exc_info()
         print('ERROR: attach file: %s\n %s %s'%(str(e),exc_type, exc_tb.tb_lineno))
+        return 0
+
+
+# upload the files with ATTACH_WORKERS threads on up to ATTACH_SESSIONS sessions of the pool
+# and link them in batches to destObj
+# return list of files that are not attached
+def uploadAttachments(conn,destObj,attachList,namespace,sessions):
+    if len(attachList) == 0:
+        return []
+    failed = []
+    uploaded = []
+    acquired = sessions.acquireMany(ATTACH_SESSIONS)
+    gateways = [session.gateway for session in acquired]
+    threadGateway = threading.local()
+    counter = iter(range(len(attachList)))
+    lock = threading.Lock()
+
+    def upload(attachFile):
+        if not hasattr(threadGateway,"conn"):
+            with lock:
+                threadGateway.conn = gateways[next(counter) % len(gateways)]
+        print("\tATTACH File %s to %s "%(attachFile,str(destObj)))
+        return threadGateway.conn.createFileAnnfromLocalFile(attachFile, mimetype="text/plain",
+                                                              ns=namespace, desc=None)
 
+    try:
+        with ThreadPoolExecutor(ATTACH_WORKERS) as exe:
+            futures = {exe.submit(upload,f):f for f in attachList}
+            for future in as_completed(futures):
+                try:
+                    uploaded.append((futures[future],future.result().getId()))
+                except Exception as e:
+                    print("ERROR: upload of %s failed: %s"%(futures[future],str(e)))
+                    failed.append(futures[future])
+    finally:
+        for session in acquired:
+            sessions.release(session)
+
+    failed.extend(linkAnnotations(conn,destObj,uploaded))
+    return failed
+
+
+# link file annotations [(file, annotationID)] to destObj, ATTACH_LINK_BATCH links per call
+# return list of files that are not linked
+def linkAnnotations(conn,destObj,uploaded):
+    failed = []
+    if destObj.OMERO_CLASS == "Project":
+        linkClass,parentClass = omero.model.ProjectAnnotationLinkI,omero.model.ProjectI
+    else:
+        linkClass,parentClass = omero.model.DatasetAnnotationLinkI,omero.model.DatasetI
+
+    def createLink(annID):
+        link = linkClass()
+        link.setParent(parentClass(destObj.getId(),False))
+        link.setChild(omero.model.FileAnnotationI(annID,False))
+        return link
 
-def cliImport(client,ipath,destID,skip,depth,namespace,dataset=None,conn=None):
+    for i in range(0,len(uploaded),ATTACH_LINK_BATCH):
+        batch = uploaded[i:i+ATTACH_LINK_BATCH]
+        try:
+            conn.getUpdateService().saveArray([createLink(annID) for f,annID in batch])
+        except Exception:
+            # link one by one to find the failing file
+            for f,annID in batch:
+                try:
+                    conn.getUpdateService().saveObject(createLink(annID))
+                except Exception as e:
+                    print("ERROR: link of %s failed: %s"%(f,str(e)))
+                    failed.append(f)
+    return failed
+
+
+# wait until the session of client answers, return False after READY_TIMEOUT
+def waitUntilReady(client):
+    endTime = time.time() + READY_TIMEOUT
+    while True:
+        try:
+            client.getSession().getAdminService().getEventContext()
+            return True
+        except Exception as e:
+            if time.time() > endTime:
+                print("ERROR: session not ready: %s"%str(e))
+                return False
+            time.sleep(1)
+
+
+# session of the pool: omero.cli.CLI with loaded plugins and its own secure client
+class ImportSession:
+    def __init__(self,client):
+        self.client = client.createClient(secure=True)
+        self.cli = omero.cli.CLI()
+        self.cli.loadplugins()
+        self.cli.set_client(self.client)
+        self.gateway = BlitzGateway(client_obj=self.client)
+
+
+# warm, authenticated sessions shared by the import jobs, the retries and the attachment uploads
+class SessionPool:
+    def __init__(self,client,size):
+        self.sessions = []
+        self.free = queue.Queue()
+        with ThreadPoolExecutor(size) as exe:
+            for session in exe.map(lambda i: ImportSession(client),range(size)):
+                if waitUntilReady(session.client):
+                    self.sessions.append(session)
+                    self.free.put(session)
+        if len(self.sessions) == 0:
+            raise Exception("no session available for import")
+        print("Session pool with %d sessions ready"%len(self.sessions))
+
+    def acquire(self):
+        return self.free.get()
+
+    # one session (blocking) and up to n-1 further free sessions
+    def acquireMany(self,n):
+        acquired = [self.acquire()]
+        while len(acquired) < n:
+            try:
+                acquired.append(self.free.get_nowait())
+            except queue.Empty:
+                break
+        return acquired
+
+    def release(self,session):
+        self.free.put(session)
+
+    def close(self):
+        for session in self.sessions:
+            try:
+                session.client.closeSession()
+            except Exception as e:
+                print("WARN: close session: %s"%str(e))
+
+
+# return skipped files, imported files and the ImportLogTail of the import
+def cliImport(sessions,ipath,destID,skip,depth,namespace,dataset=None,conn=None,journal=None,parallel=(2,2)):
     # create import call string
-    args = createArgumentList(ipath,destID,skip,depth)
+    args = createArgumentList(ipath,destID,skip,depth,parallel,journal is not None and journal.resumed)
     print(args)
     images_skipped = None
     images_imported = None
+    progress = None
+    label = ipath if isinstance(ipath,str) else "%d files"%len(ipath)
 
+    session = sessions.acquire()
     try:
         with tempfile.NamedTemporaryFile(suffix=".stdout") as stdout:
             with tempfile.NamedTemporaryFile(suffix=".stderr") as stderr:
-                cli = omero.cli.CLI()
-                cli.loadplugins()
-                #cli.set_client(client)
-                cli.set_client(client.createClient(secure=True))
+                cli = session.cli
                 args.extend(["--file", stdout.name])
                 args.extend(["--errs", stderr.name])
 
-                cli.invoke(args)
-                images_skipped,images_imported=parseLogFile(stderr)
+                progress = ImportLogTail(stderr.name,label,journal)
+                progress.start()
+                try:
+                    cli.invoke(args)
+                finally:
+                    with span("log parse",label) as record:
+                        progress.finish()
+                        record["files"] = len(progress.images_imported) + len(progress.images_skipped)
+                images_skipped,images_imported=progress.images_skipped,progress.images_imported
                 print ("Images imported: ",len(images_imported))
                 print ("Images skipped: ",len(images_skipped))
 
@@ -325,19 +931,20 @@ def cliImport(client,ipath,destID,skip,depth,namespace,dataset=None,conn=None):
                         stderr.name, mimetype="text/csv",ns=namespace+"_log" )
                     dataset.linkAnnotation(ann)
 
-                return images_skipped,images_imported,stderr
+                return images_skipped,images_imported,progress
     except Exception as e:
         exc_type, exc_obj, exc_tb = sys.exc_info()
         print ('ERROR at cli import: %s\n %s %s'%(str(e),exc_type, exc_tb.tb_lineno))
-        return None,None,None
+        return None,None,progress
     finally:
-        return images_skipped,images_imported,None
+        sessions.release(session)
+        return images_skipped,images_imported,progress
 
 
 
 
-def retryImport(client, destinationID, filesForNewlyImport, images_skipped, numOfImportedFiles, skip,namespace):
-    # retry failed imports
+# retry failed imports, one cli import call per batch of RETRY_BATCH_SIZE files
+def retryImport(sessions, destinationID, filesForNewlyImport, images_skipped, numOfImportedFiles, skip,namespace,journal=None):
     not_imported_imgList = []
     messageRetry = ""
     retry=False
@@ -345,61 +952,129 @@ def retryImport(client, destinationID, filesForNewlyImport, images_skipped, numO
         retry = True
         messageRetry = "-----Retry Import For: " + str(len(filesForNewlyImport)) + " ------"
         print("---- Retry import-----")
-        for f in filesForNewlyImport:
-            print("Retry import for: ", f)
-            messageRetry = messageRetry + "\n" + f
-            r_images_skipped, r_images_imported,log = cliImport(client, f,destinationID,skip,1,namespace)
-
-            # now the file should be imported or skipped
-            if r_images_imported is not None and len(r_images_imported) > 0:
-                numOfImportedFiles = numOfImportedFiles + 1
-            elif r_images_skipped is not None and len(r_images_skipped) > 0:
-                images_skipped.append(f)
-            else: #failed
-                not_imported_imgList.append(f)
+        for i in range(0,len(filesForNewlyImport),RETRY_BATCH_SIZE):
+            batch = filesForNewlyImport[i:i+RETRY_BATCH_SIZE]
+            print("Retry import for %d files"%len(batch))
+            r_images_skipped, r_images_imported,log = cliImport(sessions, batch,destinationID,skip,1,namespace,journal=journal,
+                                                                parallel=getParallelLimits())
+            r_images_imported = set(r_images_imported or [])
+            r_images_skipped = set(r_images_skipped or [])
+
+            # now the files should be imported or skipped
+            for f in batch:
+                messageRetry = messageRetry + "\n" + f
+                resolved = Path(f).resolve().as_posix()
+                if resolved in r_images_imported:
+                    print("Retry import for: %s -> imported"%f)
+                    numOfImportedFiles = numOfImportedFiles + 1
+                elif resolved in r_images_skipped:
+                    print("Retry import for: %s -> skipped"%f)
+                    images_skipped.append(f)
+                else: #failed
+                    print("Retry import for: %s -> failed"%f)
+                    not_imported_imgList.append(f)
     return messageRetry, not_imported_imgList,images_skipped,numOfImportedFiles, retry
 
 
 
-def importContent(conn, params,jobs,depth):
-    message=None
-    try:
-        namespace = params.get(PARAM_WS)
-        client=conn.c
+# import, validation, attachment and retry for one job (source path -> dataset)
+# return retry message, list of not imported files, list of skipped files and imported bytes
+def importJob(conn,sessions,params,ipath,destID,depth,journal):
+    namespace = params.get(PARAM_WS)
+    destDataset = conn.getObject('Dataset', destID)
+    if destDataset is None:
+        print("ERROR: target dataset %s of %s not found"%(destID,ipath))
+        return "",[],[],0
+
+    # files imported by an interrupted run have the same client path
+    skip=params.get(PARAM_SKIP_EXISTING) or journal.resumed
+
+    # call import
+    jobPath = ipath
+    ipath = ipath.replace(" ", "\\ ")
+    print("\n Import files from : %s \n"%ipath)
+    profile = profileJob(ipath,depth)
+    parallel,reason = chooseParallelism(profile,INPLACE_IMPORT)
+    print("Parallel import of %d files (%s): --parallel-fileset %d --parallel-upload %d (%s)"%(
+        profile["files"],formatBytes(profile["bytes"]),parallel[0],parallel[1],reason))
+    with span("cli import",jobPath,files=profile["files"],bytes=profile["bytes"]):
+        images_skipped,images_imported,log=cliImport(sessions,ipath,destID,skip,depth,namespace,destDataset,conn,journal,parallel)
+    if images_skipped is None or images_imported is None:
+        print("ERROR: import failed for %s"%ipath)
+        return "",[ipath],[],0
+
+    # validate import
+    with span("validation",jobPath,files=profile["files"]):
+        filesForNewlyImport,other_fList=validateImport(images_skipped,images_imported,ipath,depth,
+                                                      profile["filesets"],profile["paths"])
+    # no retry for files imported by the interrupted run
+    filesForNewlyImport = [f for f in filesForNewlyImport if not journal.isImported(f)]
+    if log is not None and log.aborted:
+        # systematic failure, a retry would fail too
+        print("ERROR: import of %s stopped early, no retry for %d files"%(ipath,len(filesForNewlyImport)))
+        notImported = filesForNewlyImport
+        filesForNewlyImport = []
+
+    # attach files
+    if params.get(PARAM_ATTACH):
+        with span("attachment",jobPath) as record:
+            record["files"] = attachFiles(conn,destID,params.get(PARAM_DEST_ATTACH),
+                                          params.get(PARAM_ATTACH_FILTER),ipath,namespace,depth,sessions,
+                                          sorted(profile["filesets"]["nonImage"]),profile["paths"])
+
+    with span("retry",jobPath,files=len(filesForNewlyImport)):
+        messageRetry,not_imported_imgList,images_skipped,numOfImportedFiles, retry = \
+            retryImport(sessions, destID, filesForNewlyImport,images_skipped, len(images_imported),skip,namespace,journal)
+    if log is not None and log.aborted:
+        not_imported_imgList.extend(notImported)
+    else:
+        journal.jobDone(jobPath)
 
-        all_skipped_img=[]
-        all_notImported_img=[]
+    return messageRetry,not_imported_imgList,images_skipped,log.importedBytes if log is not None else 0
 
-        for ipath in jobs:
-            if ipath is not None:
 
+# run the jobs with IMPORT_JOBS parallel import jobs
+def importContent(conn, params,jobs,depth,sessions,journal):
+    message=None
+    messageRetry=""
+    all_skipped_img=[]
+    all_notImported_img=[]
+    importedBytes=0
+    startTime=time.time()
+    filesetMax,uploadMax = getParallelLimits()
+    print("Run %d import jobs at the same time with max. --parallel-fileset %d / --parallel-upload %d each"
+          " (max. %d filesets / %d uploads in total)"%(IMPORT_JOBS,filesetMax,uploadMax,
+                                                       IMPORT_JOBS*filesetMax,IMPORT_JOBS*uploadMax))
+    try:
+        with ThreadPoolExecutor(IMPORT_JOBS) as exe:
+            futures = {}
+            for ipath in jobs:
+                if ipath is not None:
+                    if journal.isJobDone(ipath):
+                        print("Import job done by the interrupted run: %s"%ipath)
+                        message="Imports Finished! "
+                        continue
+                    futures[ipath] = exe.submit(importJob,conn,sessions,params,ipath,jobs[ipath],depth,journal)
+
+            # merge results in job order
+            for ipath in futures:
                 print("#--------------------------------------------------------------------\n")
-                destID =jobs[ipath]
-                destDataset = conn.getObject('Dataset', destID)
-
-                if destDataset is not None:
-                    skip=params.get(PARAM_SKIP_EXISTING)
-
-                    # call import
-                    ipath = ipath.replace(" ", "\\ ")
-                    print("\n Import files from : %s \n"%ipath)
-                    images_skipped,images_imported,log=cliImport(client,ipath,destID,skip,depth,namespace,destDataset,conn)
-
-                    # validate import
-                    filesForNewlyImport,other_fList=validateImport(images_skipped,images_imported,ipath)
-
-                    # attach files
-                    if params.get(PARAM_ATTACH):
-                        attachFiles(conn,destID,params.get(PARAM_DEST_ATTACH),
-                                    params.get(PARAM_ATTACH_FILTER),ipath,namespace,depth)
-
-                    messageRetry,not_imported_imgList,images_skipped,numOfImportedFiles, retry = \
-                        retryImport(client, destID, filesForNewlyImport,images_skipped, len(images_imported),skip,namespace)
-
-                    message="Imports Finished! "
-
-                    all_notImported_img.extend(not_imported_imgList)
-                    all_skipped_img.extend(images_skipped)
+                try:
+                    r_messageRetry,not_imported_imgList,images_skipped,r_importedBytes = futures[ipath].result()
+                except Exception as e:
+                    print('ERROR: Failed to import %s: %s'%(ipath,str(e)))
+                    all_notImported_img.append(ipath)
+                    continue
+                print("Import job finished: %s -> %s"%(ipath,jobs[ipath]))
+                if r_messageRetry:
+                    messageRetry = messageRetry + "\n" + r_messageRetry
+                message="Imports Finished! "
+
+                all_notImported_img.extend(not_imported_imgList)
+                all_skipped_img.extend(images_skipped)
+                importedBytes += r_importedBytes
+
+        recordThroughput(params.get(PARAM_WS),"import",importedBytes,time.time()-startTime)
 
     # todo attach files in separates try catch
     except Exception as e: # work on python 3.x
@@ -415,6 +1090,8 @@ def importContent(conn, params,jobs,depth):
             errmessage="ATTENTION: there are failed imports (%d), please check the activity report" \
                        "or the dataset comment report"%(len(all_notImported_img))
             message = errmessage
+            if COPY_SOURCES:
+                forgetTransferred(conn,params.get(PARAM_WS),all_notImported_img,depth)
 
         if not message:
             return "No imports!"
@@ -423,16 +1100,29 @@ def importContent(conn, params,jobs,depth):
 
 
 
-def existsAsChildOf(destObj,name):
+# name -> id of all child datasets of the project, loaded once per import
+def loadDatasetIndex(destObj):
+    index = {}
     for dSet in destObj.listChildren():
-        if dSet.getName() == name:
-            print ("\t* Dataset directory still exists: ",name)
-            return dSet.getId()
-    return None
+        index.setdefault(dSet.getName(),dSet.getId())
+    return index
+
+
+def existsAsChildOf(datasetIndex,name):
+    existingID = datasetIndex.get(name)
+    if existingID:
+        print ("\t* Dataset directory still exists: ",name)
+    return existingID
 
 
-def scanSubdir(conn,currentdir,pName,jobs,destObj):
-    # creation of new dataset if not exists
+# subdirectories of path in one directory read
+def listSubdirs(path):
+    with os.scandir(path) as it:
+        return sorted(entry.path for entry in it if entry.is_dir())
+
+
+# plan datasets for currentdir and its subdirectories: plan={path: datasetName}
+def scanSubdir(currentdir,pName,plan):
     if not currentdir.endswith(os.sep):
         currentdir = currentdir + os.sep
     dName = os.path.split(os.path.dirname(currentdir))[1]
@@ -440,20 +1130,38 @@ def scanSubdir(conn,currentdir,pName,jobs,destObj):
         datasetName = "%s_%s"%(pName,dName)
     else:
         datasetName = dName
-
-    existingID = existsAsChildOf(destObj,datasetName)
-
-    if not existingID:
-        existingID = createDataset(conn,destObj.getId(),datasetName)
     # dir append to joblist
-    jobs[currentdir]=existingID
+    plan[currentdir]=datasetName
 
     # recursion for subdirs
-    subdirs = filter(os.path.isdir, [os.path.join(currentdir, x) for x in os.listdir(currentdir)])
-    for dir in subdirs:
-        jobs = scanSubdir(conn,dir,datasetName,jobs,destObj)
+    for dir in listSubdirs(currentdir):
+        plan = scanSubdir(dir,datasetName,plan)
+
+    return plan
+
+# common dataset for direct files under Omero_Importdir/<user>/ and datasets like directories
+# return plan={path: datasetName} or None
+def planJobs(datapath,namespace):
+    plan={}
+    plan[datapath]=namespace
+    try:
+        for dir in listSubdirs(datapath):
+            plan = scanSubdir(dir,None,plan)
+    except Exception as e:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        print('ERROR: while reading mount dir: %s\n %s %s'%(str(e),exc_type, exc_tb.tb_lineno))
+        return None
+    return plan
+
+
+# dataset names of the plan that are not yet children of the project
+def missingDatasets(plan,datasetIndex):
+    missing = []
+    for datasetName in plan.values():
+        if not existsAsChildOf(datasetIndex,datasetName) and datasetName not in missing:
+            missing.append(datasetName)
+    return missing
 
-    return jobs
 
 # jobs={path_0:tID_0,...,path_N:tID_N}
 def getJobsAndTargets(conn,datapath,destType,destID,destObj,namespace):
@@ -464,72 +1172,1222 @@ def getJobsAndTargets(conn,datapath,destType,destID,destObj,namespace):
         jobs[datapath] = destID
         return jobs,DEPTH
     else: # target = project
-        # create common dataset for direct files under Omero_Importdir/<user>/
-        datasetName = namespace
-        existingID = existsAsChildOf(destObj,datasetName)
-
-        if not existingID:
-            existingID = createDataset(conn,destObj.getId(),datasetName)
+        with span("scan") as record:
+            plan = planJobs(datapath,namespace)
+            if plan is None:
+                return None,1
+            record["files"] = len(plan)
+
+        # create all missing datasets at once
+        datasetIndex = loadDatasetIndex(destObj)
+        missing = missingDatasets(plan,datasetIndex)
+        with span("dataset creation",files=len(missing)):
+            datasetIndex.update(createDatasets(conn,destObj.getId(),missing))
 
         jobs={}
-        jobs[datapath]=existingID
+        for path in plan:
+            jobs[path]=datasetIndex[plan[path]]
 
-        # create datasets like directories
+        return jobs,1
+
+
+def formatBytes(size):
+    for unit in ["B","KB","MB","GB","TB"]:
+        if size < 1024 or unit == "TB":
+            return "%.1f %s"%(size,unit)
+        size = size / 1024.0
+
+
+# walk the complete source tree, return list of subdirectories and list of (relative path, size, mtime) of files
+def scanSourceTree(src):
+    dirs=[]
+    files=[]
+    stack=[src]
+    while stack:
+        currentdir = stack.pop()
+        with os.scandir(currentdir) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(os.path.relpath(entry.path,src))
+                    stack.append(entry.path)
+                elif entry.is_file():
+                    st = entry.stat()
+                    files.append((os.path.relpath(entry.path,src),st.st_size,st.st_mtime))
+                else:
+                    print("\t WARN: skip copy of %s (no regular file)"%entry.path)
+    return dirs,files
+
+
+# (bytes/s, read operations/s) for the copy from workstation at the time now, None is unlimited
+def getBudget(workstation,now=None):
+    now = now or datetime.datetime.now()
+    hour = now.hour + now.minute / 60.0
+    for start,end,bytesRate,opsRate in WORKSTATION_BUDGETS.get(workstation,[]):
+        if (start <= hour < end) if start <= end else (hour >= start or hour < end):
+            return bytesRate,opsRate
+    return None,None
+
+
+# token bucket with a burst of one second, consume() waits until the taken amount is covered by the rate
+class TokenBucket:
+    def __init__(self,rate=None,clock=time.monotonic,sleep=time.sleep):
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.rate = None
+        self.setRate(rate)
+
+    def setRate(self,rate):
+        with self.lock:
+            if rate != self.rate:
+                self.rate = rate
+                self.tokens = rate or 0
+                self.last = self.clock()
+
+    def consume(self,amount):
+        with self.lock:
+            if not self.rate:
+                return
+            now = self.clock()
+            self.tokens = min(self.rate,self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            self.sleep(wait)
+
+
+# bandwidth and read operation budget of the copy threads from one workstation (see WORKSTATION_BUDGETS),
+# the budget of the time of day is checked every UPDATE_INTERVAL seconds
+class WorkstationThrottle:
+    UPDATE_INTERVAL = 60
+
+    def __init__(self,workstation):
+        self.workstation = workstation
+        self.bytes = TokenBucket()
+        self.ops = TokenBucket()
+        self.nextUpdate = 0
+
+    def update(self):
+        bytesRate,opsRate = getBudget(self.workstation)
+        if (bytesRate,opsRate) != (self.bytes.rate,self.ops.rate):
+            print("Copy budget of %s: %s, %s"%(self.workstation,
+                  "%s/s"%formatBytes(bytesRate) if bytesRate else "unlimited bandwidth",
+                  "%d read operations/s"%opsRate if opsRate else "unlimited read operations"),flush=True)
+        self.bytes.setRate(bytesRate)
+        self.ops.setRate(opsRate)
+
+    def consume(self,numBytes,ops=1):
+        now = time.monotonic()
+        if now >= self.nextUpdate:
+            self.nextUpdate = now + self.UPDATE_INTERVAL
+            self.update()
+        self.ops.consume(ops)
+        self.bytes.consume(numBytes)
+
+
+# throttle for the copy from workstation, None if there is no budget
+def getThrottle(workstation):
+    if not WORKSTATION_BUDGETS.get(workstation):
+        return None
+    return WorkstationThrottle(workstation)
+
+
+# read fsrc in chunks, within the budget of throttle
+def readChunks(fsrc,throttle=None):
+    for chunk in iter(lambda: fsrc.read(COPY_CHUNK_SIZE), b""):
+        if throttle is not None:
+            throttle.consume(len(chunk))
+        yield chunk
+
+
+# copy in kernel space, fallback from copy_file_range to sendfile to user space copy
+def kernelCopy(fsrc,fdst,size,throttle=None):
+    offset = 0
+    for method in ("copy_file_range","sendfile"):
+        if not hasattr(os,method):
+            continue
         try:
-            subdirs = filter(os.path.isdir, [os.path.join(datapath, x) for x in os.listdir(datapath)])
-            for dir in subdirs:
-                jobs = scanSubdir(conn,dir,None,jobs,destObj)
-        except Exception as e:
-            exc_type, exc_obj, exc_tb = sys.exc_info()
-            print('ERROR: while reading mount dir: %s\n %s %s'%(str(e),exc_type, exc_tb.tb_lineno))
-            return None,1
+            while offset < size:
+                count = min(COPY_CHUNK_SIZE,size-offset)
+                if method == "copy_file_range":
+                    # explicit offsets, the file positions are not moved
+                    sent = os.copy_file_range(fsrc.fileno(),fdst.fileno(),count,offset,offset)
+                else:
+                    # writes at the position of fdst
+                    sent = os.sendfile(fdst.fileno(),fsrc.fileno(),offset,count)
+                if sent == 0:
+                    break
+                offset += sent
+                if throttle is not None:
+                    throttle.consume(sent)
+            return offset
+        except OSError:
+            # not supported for this pair of filesystems, continue after the copied part
+            os.lseek(fdst.fileno(),offset,os.SEEK_SET)
+            continue
+    fsrc.seek(offset)
+    fdst.seek(offset)
+    for chunk in readChunks(fsrc,throttle):
+        fdst.write(chunk)
+    return fdst.tell()
+
+
+# copy in user space and compute the sha1 of the streamed bytes, return number of bytes and sha1
+def hashCopy(fsrc,fdst,throttle=None):
+    sha1 = hashlib.sha1()
+    numBytes = 0
+    for chunk in readChunks(fsrc,throttle):
+        sha1.update(chunk)
+        fdst.write(chunk)
+        numBytes += len(chunk)
+    return numBytes,sha1.hexdigest()
+
+
+FICLONE = 0x40049409
+
+# clone the extents of srcFile (no data is read or written), raise OSError if the filesystem has no reflinks
+def reflinkFile(srcFile,destFile):
+    with open(srcFile,"rb") as fsrc:
+        with open(destFile,"wb") as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(),FICLONE,fsrc.fileno())
+            except OSError:
+                fdst.close()
+                os.remove(destFile)
+                raise
+    shutil.copystat(srcFile,destFile)
+
+
+# link mode for the staging from src to dest: STAGING_LINK_MODE if both are on the same filesystem, else None
+def getStagingLinkMode(src,dest):
+    if STAGING_LINK_MODE not in ("reflink","hardlink"):
+        return None
+    if os.stat(src).st_dev != os.stat(dest).st_dev:
+        return None
+    return STAGING_LINK_MODE
+
+
+# stage srcFile as destFile by reflink/hardlink (link) or copy
+# return destination file, sha1 of the copied content (None if linked or COPY_VERIFY is disabled) and used method
+def stageFile(srcFile,destFile,size,link=None,throttle=None):
+    if os.path.lexists(destFile):
+        if os.path.exists(destFile) and os.path.samefile(srcFile,destFile):
+            # hardlink of an interrupted run, writing to it would truncate the source
+            return destFile,None,"hardlink"
+        os.remove(destFile)
+    try:
+        if link == "reflink":
+            reflinkFile(srcFile,destFile)
+            return destFile,None,link
+        if link == "hardlink":
+            os.link(srcFile,destFile)
+            return destFile,None,link
+    except FileExistsError:
+        # staged by another run in the meantime, never copy over a possible link to the source
+        raise
+    except OSError:
+        # no reflink support (or no link permission), copy the file
+        pass
+    destFile,sha1 = copyFile(srcFile,destFile,size,throttle=throttle)
+    return destFile,sha1,"copy"
+
+
+# return destination file and sha1 of the copied content (None if COPY_VERIFY and verify are disabled)
+def copyFile(srcFile,destFile,size,verify=False,throttle=None):
+    sha1 = None
+    if throttle is not None:
+        # open and stat of the source
+        throttle.consume(0)
+    with open(srcFile,"rb") as fsrc:
+        before = os.fstat(fsrc.fileno())
+        with open(destFile,"wb") as fdst:
+            if COPY_VERIFY or verify:
+                numBytes,sha1 = hashCopy(fsrc,fdst,throttle)
+            elif size >= LARGE_FILE_SIZE:
+                numBytes = kernelCopy(fsrc,fdst,size,throttle)
+            else:
+                for chunk in readChunks(fsrc,throttle):
+                    fdst.write(chunk)
+                numBytes = fdst.tell()
+        after = os.stat(srcFile)
+    # short reads of the mount or a source modified during the copy
+    if numBytes != size or (after.st_size,after.st_mtime) != (before.st_size,before.st_mtime):
+        os.remove(destFile)
+        raise IOError("copy verification failed: read %d of %d bytes, source size %d, mtime changed: %s"%(
+            numBytes,size,after.st_size,after.st_mtime != before.st_mtime))
+    shutil.copystat(srcFile,destFile)
+    return destFile,sha1
+
+
+def getStorePath(sha1):
+    return os.path.join(DEDUP_STORE_PATH,sha1[:2],sha1)
+
+
+# stage srcFile as destFile by a hardlink into the content-addressed store,
+# copy the content into the store only if it is not there yet (sha1: known checksum of srcFile from the manifest)
+# return destination file, sha1 and "dedup" if the content was already in the store or "copy"
+def stageDedupFile(srcFile,destFile,size,sha1=None,throttle=None):
+    if sha1 is not None and os.path.isfile(getStorePath(sha1)):
+        method = "dedup"
+    else:
+        tmpDir = os.path.join(DEDUP_STORE_PATH,"tmp")
+        os.makedirs(tmpDir,exist_ok=True)
+        tmpFile = os.path.join(tmpDir,uuid.uuid4().hex)
+        try:
+            tmpFile,sha1 = copyFile(srcFile,tmpFile,size,verify=True,throttle=throttle)
+            storeFile = getStorePath(sha1)
+            os.makedirs(os.path.dirname(storeFile),exist_ok=True)
+            try:
+                # content in store is shared by all views, protect it against changes
+                os.chmod(tmpFile,0o444)
+                os.link(tmpFile,storeFile)
+                method = "copy"
+            except FileExistsError:
+                # same content stored by an earlier run or another thread
+                method = "dedup"
+        finally:
+            if os.path.exists(tmpFile):
+                os.remove(tmpFile)
+    storeFile = getStorePath(sha1)
+    if os.path.lexists(destFile):
+        if os.path.exists(destFile) and os.path.samefile(storeFile,destFile):
+            # linked by an interrupted run before it was journaled
+            return destFile,sha1,method
+        os.remove(destFile)
+    os.link(storeFile,destFile)
+    return destFile,sha1,method
+
+
+# checksums of the copied files in dest/CHECKSUM_FILE: {relative path: sha1}
+def loadChecksums(dest):
+    checksums = {}
+    checksumPath = os.path.join(dest,CHECKSUM_FILE)
+    if os.path.isfile(checksumPath):
+        with open(checksumPath) as f:
+            for line in f:
+                parts = line.rstrip("\n").split("  ",1)
+                if len(parts) == 2:
+                    checksums[parts[1]] = parts[0]
+    return checksums
+
+
+# thread safe progress report of the copy threads
+class CopyProgress:
+    def __init__(self,numFiles,numBytes):
+        self.numFiles = numFiles
+        self.numBytes = numBytes
+        self.copiedFiles = 0
+        self.copiedBytes = 0
+        self.failed = []
+        self.checksums = {}
+        self.linkedFiles = 0
+        self.linkedBytes = 0
+        self.lock = threading.Lock()
+
+    def done(self,srcFile,destFile,size):
+        with self.lock:
+            self.copiedFiles += 1
+            self.copiedBytes += size
+            print(".copied [%d/%d files, %s/%s] %s to %s"%(self.copiedFiles,self.numFiles,
+                                                           formatBytes(self.copiedBytes),formatBytes(self.numBytes),
+                                                           srcFile,destFile),flush=True)
+
+    def linked(self,size):
+        with self.lock:
+            self.linkedFiles += 1
+            self.linkedBytes += size
+
+    def error(self,srcFile,e):
+        with self.lock:
+            self.failed.append(srcFile)
+            print("ERROR: copy of %s failed: %s"%(srcFile,str(e)),flush=True)
+
+
+# many small files: the per file latency of the mount dominates the copy
+def isBundleTransfer(files):
+    if BUNDLE_AVG_FILE_SIZE <= 0 or len(files) < BUNDLE_MIN_FILES or shutil.which("tar") is None:
+        return False
+    return sum(f[1] for f in files) / len(files) < BUNDLE_AVG_FILE_SIZE
+
+
+# read the files (relative path, size, mtime) below src with one tar process as sequential stream
+# and unpack the stream to dest, with sha1 of every file if COPY_VERIFY
+# done(f,destFile,sha1) / failed(f,exception) are called for every file
+def bundleCopy(src,dest,files,done,failed,throttle=None):
+    pending = {f[0]:f for f in files}
+    with tempfile.TemporaryFile() as stderr:
+        proc = subprocess.Popen(["tar","-C",src,"--null","--no-recursion","-T","-","-cf","-"],
+                                stdin=subprocess.PIPE,stdout=subprocess.PIPE,stderr=stderr)
+
+        def writeFileList():
+            try:
+                for relPath in pending:
+                    proc.stdin.write(os.fsencode(relPath) + b"\0")
+            finally:
+                proc.stdin.close()
+        feeder = threading.Thread(target=writeFileList,daemon=True)
+        feeder.start()
+
+        try:
+            with tarfile.open(fileobj=proc.stdout,mode="r|") as archive:
+                for member in archive:
+                    f = pending.pop(member.name,None)
+                    if f is None or not member.isfile():
+                        continue
+                    destFile = os.path.join(dest,f[0])
+                    try:
+                        os.makedirs(os.path.dirname(destFile),exist_ok=True)
+                        if throttle is not None:
+                            throttle.consume(0)
+                        with open(destFile,"wb") as fdst:
+                            if COPY_VERIFY:
+                                numBytes,sha1 = hashCopy(archive.extractfile(member),fdst,throttle)
+                            else:
+                                for chunk in readChunks(archive.extractfile(member),throttle):
+                                    fdst.write(chunk)
+                                numBytes,sha1 = fdst.tell(),None
+                        after = os.stat(os.path.join(src,f[0]))
+                        # short reads of the mount or a source modified during the copy
+                        if numBytes != f[1] or (after.st_size,after.st_mtime) != (f[1],f[2]):
+                            os.remove(destFile)
+                            raise IOError("copy verification failed: read %d of %d bytes, source size %d, mtime changed: %s"%(
+                                numBytes,f[1],after.st_size,after.st_mtime != f[2]))
+                        os.chmod(destFile,member.mode)
+                        os.utime(destFile,(f[2],f[2]))
+                        done(f,destFile,sha1)
+                    except Exception as e:
+                        failed(f,e)
+        finally:
+            proc.stdout.close()
+            proc.wait()
+            feeder.join()
+
+        if proc.returncode != 0:
+            stderr.seek(0)
+            print("WARN: tar stream of %s finished with %d: %s"%(src,proc.returncode,
+                                                                 stderr.read().decode(errors="replace").strip()))
+    # not in the stream (unreadable or removed)
+    for f in pending.values():
+        failed(f,IOError("missing in tar stream"))
+
+
+# copy the given dirs and files (relative to src) to dest with COPY_WORKERS threads,
+# by reflink/hardlink if src and dest are on the same filesystem (see STAGING_LINK_MODE)
+# or as hardlinks into the content-addressed store (see DEDUP_STORE, known: {relative path: sha1} of unchanged files)
+# throttle: budget of the workstation (see WORKSTATION_BUDGETS)
+# return progress and list of (relative path, size, mtime) of the copied files
+def copyTree(src,dest,dirs,files,journal=None,known=None,throttle=None):
+    for d in dirs:
+        os.makedirs(os.path.join(dest,d),exist_ok=True)
+
+    link = None if DEDUP_STORE else getStagingLinkMode(src,dest)
+    known = known or {}
+    progress = CopyProgress(len(files),sum(f[1] for f in files))
+    bundle = link is None and not DEDUP_STORE and isBundleTransfer(files)
+    if bundle:
+        print("Copy %d files (%s) as one tar stream (average file size %s)"%(
+            progress.numFiles,formatBytes(progress.numBytes),formatBytes(progress.numBytes/progress.numFiles)))
+    else:
+        print("Copy %d files (%s) with %d threads%s"%(progress.numFiles,formatBytes(progress.numBytes),COPY_WORKERS,
+                                                       " (same filesystem, try %s)"%link if link else
+                                                       " (into dedup store)" if DEDUP_STORE else ""))
+
+    copied = []
+    checksumFile = open(os.path.join(dest,CHECKSUM_FILE),"a") if COPY_VERIFY or DEDUP_STORE else None
+
+    def done(f,destFile,sha1,method="copy"):
+        progress.done(os.path.join(src,f[0]),destFile,f[1])
+        copied.append(f)
+        if method != "copy":
+            progress.linked(f[1])
+        if checksumFile is not None and sha1 is not None:
+            progress.checksums[f[0]] = sha1
+            checksumFile.write("%s  %s\n"%(sha1,f[0]))
+            checksumFile.flush()
+        if journal is not None:
+            journal.copied(*f)
+
+    def failed(f,e):
+        progress.error(os.path.join(src,f[0]),e)
+
+    try:
+        if bundle:
+            bundleCopy(src,dest,files,done,failed,throttle)
+            return progress,copied
+        with ThreadPoolExecutor(COPY_WORKERS) as exe:
+            futures = {}
+            # start with the large files to keep all threads busy until the end
+            for f in sorted(files,key=lambda f: f[1],reverse=True):
+                srcFile = os.path.join(src,f[0])
+                if DEDUP_STORE:
+                    future = exe.submit(stageDedupFile,srcFile,os.path.join(dest,f[0]),f[1],known.get(f[0]),throttle)
+                else:
+                    future = exe.submit(stageFile,srcFile,os.path.join(dest,f[0]),f[1],link,throttle)
+                futures[future] = f
+            for future in as_completed(futures):
+                f = futures[future]
+                try:
+                    done(f,*future.result())
+                except Exception as e:
+                    failed(f,e)
+    finally:
+        if checksumFile is not None:
+            checksumFile.close()
+
+    return progress,copied
+
+
+def hashFile(path):
+    sha1 = hashlib.sha1()
+    with open(path,"rb") as f:
+        for chunk in iter(lambda: f.read(COPY_CHUNK_SIZE), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
 
-        return jobs,1
 
+# per user and workstation manifest of transferred files:
+# {relative path: {"size":..,"mtime":..,"sha1":..,"dest":..}}
+def getManifestPath(conn,workstation):
+    return os.path.join(get_user_repo_path(conn),"transfer_manifest_%s.json"%workstation)
 
-# copy files from source to destination
-def copy_files(src_paths, dest_dir):
-    # process all file paths
-    for src_path in src_paths:
-        # copy source file to dest file
-        dest_path = shutil.copy(src_path, dest_dir)
-        # report progress
-        print(f'.copied {src_path} to {dest_path}', flush=True)
 
+def loadManifest(manifestPath):
+    if not os.path.isfile(manifestPath):
+        return {}
+    try:
+        with open(manifestPath) as f:
+            return json.load(f)
+    except Exception as e:
+        print("WARN: can not read transfer manifest %s: %s"%(manifestPath,str(e)))
+        return {}
+
+
+def saveManifest(manifestPath,manifest):
+    tmpPath = manifestPath + ".tmp"
+    with open(tmpPath,"w") as f:
+        json.dump(manifest,f)
+    os.replace(tmpPath,manifestPath)
+
+
+# add the copied files (relative path, size, mtime) in dest with their checksums {relative path: sha1} to the manifest
+def updateManifest(manifest,dest,copied,checksums):
+    for relPath,size,mtime in copied:
+        destFile = os.path.join(dest,relPath)
+        sha1 = checksums.get(relPath)
+        if sha1 is None and MANIFEST_HASH:
+            sha1 = hashFile(destFile)
+        manifest[relPath] = {"size":size,"mtime":mtime,"dest":destFile,"sha1":sha1}
+
+
+# remove the not imported files (paths or job directories down to depth) from the transfer manifest,
+# so that a run with skip transfers and imports them again
+def forgetTransferred(conn,workstation,paths,depth):
+    manifestPath = getManifestPath(conn,workstation)
+    manifest = loadManifest(manifestPath)
+    files = set()
+    dirs = []
+    for path in paths:
+        path = os.path.realpath(str(path).replace("\\ "," "))
+        if os.path.isdir(path):
+            dirs.append(path)
+        else:
+            files.add(path)
+
+    forget = []
+    for relPath,entry in manifest.items():
+        dest = os.path.realpath(entry["dest"])
+        if dest in files:
+            forget.append(relPath)
+            continue
+        for d in dirs:
+            rel = os.path.relpath(dest,d)
+            if not rel.startswith(os.pardir) and rel.count(os.sep) < depth:
+                forget.append(relPath)
+                break
+    if len(forget) == 0:
+        return
+    print("Remove %d not imported files from the transfer manifest"%len(forget))
+    for relPath in forget:
+        del manifest[relPath]
+    try:
+        saveManifest(manifestPath,manifest)
+    except Exception as e:
+        print("WARN: can not write transfer manifest %s: %s"%(manifestPath,str(e)))
+
+
+# return the files of the scan that are not in the manifest or changed since the last transfer
+def filterChangedFiles(src,files,manifest):
+    changed = []
+    for relPath,size,mtime in files:
+        entry = manifest.get(relPath)
+        if entry is None or entry["size"] != size:
+            changed.append((relPath,size,mtime))
+        elif entry["mtime"] != mtime:
+            if MANIFEST_HASH and entry.get("sha1") and hashFile(os.path.join(src,relPath)) == entry["sha1"]:
+                # same content, only touched
+                entry["mtime"] = mtime
+            else:
+                changed.append((relPath,size,mtime))
+    return changed
+
+
+def getJournalPath(conn,workstation):
+    return os.path.join(get_user_repo_path(conn),"import_journal_%s.jsonl"%workstation)
 
-def transfer_data(conn,src):
-    # see https://superfastpython.com/multithreaded-file-copying/
-    # create the destination directory if needed
-    dest=create_new_repo_path(conn)
 
-    cmd="cp -r %s %s"%(os.path.join(src,"*"),dest)
-    status=subprocess.call(cmd, shell=True)
-    if status != 0:
-        if status < 0:
-            print("Killed by signal", status)
+# state of the last run in the journal, None if there is no journal or the last run has finished
+def loadJournal(journalPath):
+    if not os.path.isfile(journalPath):
+        return None
+    state = None
+    with open(journalPath) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # last line incomplete
+                continue
+            event = record["event"]
+            if event == "run":
+                state = {"run":record["run"],"time":record["time"],"dest":None,"copied":{},
+                         "jobs":None,"depth":None,"files":{},"doneJobs":set()}
+            elif state is None:
+                continue
+            elif event == "dest":
+                state["dest"] = record["dest"]
+            elif event == "copied":
+                state["copied"][record["rel"]] = (record["size"],record["mtime"])
+            elif event == "jobs":
+                state["jobs"] = record["jobs"]
+                state["depth"] = record["depth"]
+            elif event == "file":
+                state["files"][record["path"]] = record["status"]
+            elif event == "job":
+                state["doneJobs"].add(record["path"])
+            elif event == "finished":
+                state = None
+    return state
+
+
+# append-only journal of a run in DATA_PATH/<username>_<userID>/import_journal_<workstation>.jsonl:
+# finished copies, created datasets and import outcome per file, to resume an interrupted run
+class ImportJournal:
+    def __init__(self,journalPath,run):
+        self.lock = threading.Lock()
+        self.state = loadJournal(journalPath)
+        self.resumed = self.state is not None and self.state["run"] == run
+        if self.resumed:
+            print("Resume interrupted run of %s (%d files copied, %d import results, %d jobs done)"%(
+                self.state["time"],len(self.state["copied"]),len(self.state["files"]),len(self.state["doneJobs"])))
+            self.file = open(journalPath,"a")
         else:
-            print("Command failed with return code - ", status)
-
-    multithreaded=False
-    if multithreaded:
-        # create full paths for all files we wish to copy
-        files = [os.path.join(src,name) for name in os.listdir(src)]
-        print("# files:",len(files))
-        # determine chunksize
-        n_workers = 4
-        chunksize = round(len(files) / n_workers)
-        if chunksize==0:
-            chunksize=1
-        # create the process pool
-        with ProcessPoolExecutor(n_workers) as exe:
-            # split the copy operations into chunks
-            for i in range(0, len(files), chunksize):
-                # select a chunk of filenames
-                filenames = files[i:(i + chunksize)]
-                # submit the batch copy task
-                _ = exe.submit(copy_files, filenames, dest)
-        print('Done')
-    return dest
+            self.state = {"run":run,"dest":None,"copied":{},"jobs":None,"depth":None,"files":{},"doneJobs":set()}
+            os.makedirs(os.path.dirname(journalPath),exist_ok=True)
+            self.file = open(journalPath,"w")
+            self.write("run",sync=True,run=run,time=datetime.datetime.now().isoformat())
+
+    def write(self,event,sync=False,**data):
+        data["event"] = event
+        with self.lock:
+            self.file.write(json.dumps(data) + "\n")
+            self.file.flush()
+            if sync:
+                os.fsync(self.file.fileno())
+
+    def setDest(self,dest):
+        self.state["dest"] = dest
+        self.write("dest",sync=True,dest=dest)
+
+    def copied(self,relPath,size,mtime):
+        self.write("copied",rel=relPath,size=size,mtime=mtime)
+
+    def isCopied(self,relPath,size,mtime):
+        return self.state["copied"].get(relPath) == (size,mtime)
+
+    def setJobs(self,jobs,depth):
+        self.state["jobs"] = jobs
+        self.state["depth"] = depth
+        self.write("jobs",sync=True,jobs=jobs,depth=depth)
+
+    def fileDone(self,path,status):
+        self.write("file",path=path,status=status)
+
+    # imported by the interrupted run
+    def isImported(self,path):
+        return self.resumed and self.state["files"].get(Path(path).resolve().as_posix()) == "imported"
+
+    def jobDone(self,path):
+        self.write("job",sync=True,path=path)
+
+    def isJobDone(self,path):
+        return path in self.state["doneJobs"]
+
+    def finish(self):
+        self.write("finished",sync=True)
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+
+# copy data from src to a new directory under DATA_PATH
+# skip: transfer only new or changed files (see transfer manifest)
+# journal: resume the copy into the directory of an interrupted run
+# return destination path and number of transferred files
+def transfer_data(conn,src,workstation,skip=False,journal=None):
+    if journal is not None and journal.state["dest"]:
+        dest = journal.state["dest"]
+        print("Continue transfer to %s"%dest)
+    else:
+        # create the destination directory if needed
+        dest=create_new_repo_path(conn)
+        if journal is not None:
+            journal.setDest(dest)
+
+    startTime = time.time()
+    dirs,files = scanSourceTree(src)
+    manifestPath = getManifestPath(conn,workstation)
+    manifest = loadManifest(manifestPath)
+    if skip:
+        numFiles = len(files)
+        files = filterChangedFiles(src,files,manifest)
+        print("Transfer %d new or changed files, skip %d already transferred files"%(len(files),numFiles-len(files)))
+        # only create the directories of the transferred files
+        dirs = sorted({os.path.dirname(f[0]) for f in files if os.path.dirname(f[0])})
+
+    copiedBefore = []
+    if journal is not None and journal.resumed:
+        copiedBefore = [f for f in files if journal.isCopied(*f)]
+        files = [f for f in files if not journal.isCopied(*f)]
+        print("Skip %d files copied by the interrupted run"%len(copiedBefore))
+
+    # checksums of unchanged files, the dedup store is checked for them without reading the source
+    known = {}
+    if DEDUP_STORE:
+        for relPath,size,mtime in files:
+            entry = manifest.get(relPath)
+            if entry is not None and entry.get("sha1") and (entry["size"],entry["mtime"]) == (size,mtime):
+                known[relPath] = entry["sha1"]
+
+    with span("transfer") as record:
+        progress,copied = copyTree(src,dest,dirs,files,journal,known,getThrottle(workstation))
+        record["files"] = len(copied)
+        record["bytes"] = progress.copiedBytes
+    copied.extend(copiedBefore)
+    duration = time.time() - startTime
+    print("Duration Copy: %.1f s (%s/s)"%(duration,formatBytes(progress.copiedBytes/max(duration,0.001))))
+    if progress.linkedFiles > 0:
+        print("Staged %d files (%s) by %s without copy"%(progress.linkedFiles,formatBytes(progress.linkedBytes),
+                                                        "dedup store" if DEDUP_STORE else STAGING_LINK_MODE))
+    elif progress.copiedBytes > 0:
+        # linked files would distort the measured copy throughput of the workstation
+        recordThroughput(workstation,"copy",progress.copiedBytes,duration)
+    if len(progress.failed) > 0:
+        print("ERROR: copy failed for %d files:"%len(progress.failed))
+        print('\n'.join(progress.failed))
+
+    checksums = progress.checksums
+    if (COPY_VERIFY or DEDUP_STORE) and copiedBefore:
+        checksums = dict(loadChecksums(dest),**checksums)
+    updateManifest(manifest,dest,copied,checksums)
+    try:
+        saveManifest(manifestPath,manifest)
+    except Exception as e:
+        print("WARN: can not write transfer manifest %s: %s"%(manifestPath,str(e)))
+
+    if (COPY_VERIFY or DEDUP_STORE) and os.path.isfile(os.path.join(dest,CHECKSUM_FILE)) \
+            and os.path.getsize(os.path.join(dest,CHECKSUM_FILE)) == 0:
+        os.remove(os.path.join(dest,CHECKSUM_FILE))
+    if len(copied) == 0 and len(dirs) == 0 and len(os.listdir(dest)) == 0:
+        # nothing transferred, remove empty timestamp directory
+        os.rmdir(dest)
+
+    return dest,len(copied)
+
+
+# measured throughput of earlier runs per workstation in DATA_PATH/throughput.json:
+# {workstation: {"copy": [[bytes, seconds],..], "import": [[bytes, seconds],..]}}
+THROUGHPUT_SAMPLES = 10
+
+def getThroughputPath():
+    return os.path.join(DATA_PATH,"throughput.json")
+
+
+def recordThroughput(workstation,kind,numBytes,seconds):
+    if numBytes <= 0 or seconds <= 0:
+        return
+    try:
+        history = loadManifest(getThroughputPath())
+        samples = history.setdefault(workstation,{}).setdefault(kind,[])
+        samples.append([numBytes,seconds])
+        del samples[:-THROUGHPUT_SAMPLES]
+        saveManifest(getThroughputPath(),history)
+    except Exception as e:
+        print("WARN: can not record throughput: %s"%str(e))
+
+
+# bytes per second of the earlier runs or None
+def getThroughput(workstation,kind):
+    samples = loadManifest(getThroughputPath()).get(workstation,{}).get(kind,[])
+    seconds = sum(s[1] for s in samples)
+    if seconds == 0:
+        return None
+    return sum(s[0] for s in samples) / seconds
+
+
+# plan of the import without copy, dataset creation and import
+# return message with the summary of the plan
+def planImport(conn,params,datapath,destType,destID,destObj):
+    workstation = params.get(PARAM_WS)
+    datasetIndex = {}
+    if destType == "Dataset":
+        plan = {datapath:destObj.getName()}
+        datasetIndex[destObj.getName()] = destID
+        depth = DEPTH
+    else:
+        plan = planJobs(datapath,workstation)
+        if plan is None:
+            return "No files found!"
+        datasetIndex = loadDatasetIndex(destObj)
+        depth = 1
+    missing = missingDatasets(plan,datasetIndex)
+
+    patterns = parseAttachFilter(params.get(PARAM_ATTACH_FILTER) or "") if params.get(PARAM_ATTACH) else ()
+    with ThreadPoolExecutor(PLAN_SCAN_WORKERS) as exe:
+        profiles = dict(zip(plan,exe.map(lambda path: profileJob(path,depth,patterns),plan)))
+    if params.get(PARAM_ATTACH) and not patterns:
+        # without filter the known non image files are attached
+        for profile in profiles.values():
+            profile["attachments"] = len(profile["filesets"]["nonImage"])
+
+    print("\n DRY RUN: import plan (source -> dataset, files, size, attachments)")
+    for path in plan:
+        profile = profiles[path]
+        dataset = "%s (new)"%plan[path] if plan[path] in missing else "%s (ID %s)"%(plan[path],datasetIndex[plan[path]])
+        print("%s -> %s: %d files (%d multi-file filesets), %s, %d attachments"%(
+            path,dataset,profile["files"],len(profile["filesets"]["leaders"]),formatBytes(profile["bytes"]),
+            profile["attachments"]))
+
+    numFiles = sum(p["files"] for p in profiles.values())
+    numBytes = sum(p["bytes"] for p in profiles.values())
+    numAttachments = sum(p["attachments"] for p in profiles.values())
+
+    estimate = 0
+    for kind in (["copy","import"] if COPY_SOURCES else ["import"]):
+        throughput = getThroughput(workstation,kind)
+        if throughput is None:
+            estimate = None
+            break
+        estimate += numBytes / throughput
+    message = "Dry run: %d jobs, %d files (%s), %d new datasets, %d existing datasets, %d attachments, estimated duration: %s"%(
+        len(plan),numFiles,formatBytes(numBytes),len(missing),len(set(plan.values())) - len(missing),numAttachments,
+        "unknown (no earlier runs)" if estimate is None else "%.1f min"%(estimate/60))
+    print(message)
+    return message
+
+
+# shared import queue of all script runs in QUEUE_PATH/queue.json.
+# A run waits until it is startable in fair-share order (fewest running jobs of the user,
+# least usage of the user in the last 24h, enqueue time) within the limits per workstation, user and total.
+class ImportQueue:
+    # history of finished jobs used for fair share and ETA
+    SHARE_WINDOW = 24 * 3600
+    HISTORY_SIZE = 200
+
+    def __init__(self,queuePath,clock=time.time,sleep=time.sleep):
+        self.clock = clock
+        self.sleep = sleep
+        os.makedirs(queuePath,exist_ok=True)
+        self.statePath = os.path.join(queuePath,"queue.json")
+        self.lockPath = os.path.join(queuePath,"queue.lock")
+        self.heartbeat = None
+
+    @contextlib.contextmanager
+    def locked(self):
+        with open(self.lockPath,"a") as lockFile:
+            fcntl.flock(lockFile,fcntl.LOCK_EX)
+            try:
+                state = {"jobs":[],"history":[]}
+                if os.path.isfile(self.statePath):
+                    with open(self.statePath) as f:
+                        state = json.load(f)
+                # drop jobs of runs that died
+                now = self.clock()
+                state["jobs"] = [j for j in state["jobs"] if now - j["heartbeat"] < QUEUE_POLL * 10]
+                yield state
+                tmpPath = self.statePath + ".tmp"
+                with open(tmpPath,"w") as f:
+                    json.dump(state,f)
+                os.replace(tmpPath,self.statePath)
+            finally:
+                fcntl.flock(lockFile,fcntl.LOCK_UN)
+
+    def enqueue(self,user,workstation,src,options):
+        job = {"id":uuid.uuid4().hex,"user":user,"workstation":workstation,"src":src,"options":options,
+               "jobs":None,"state":"waiting","enqueued":self.clock(),"heartbeat":self.clock()}
+        with self.locked() as state:
+            state["jobs"].append(job)
+        return job["id"]
+
+    def update(self,jobID,**data):
+        with self.locked() as state:
+            for j in state["jobs"]:
+                if j["id"] == jobID:
+                    j.update(data)
+                    j["heartbeat"] = self.clock()
+
+    # waiting jobs in fair-share order
+    def order(self,state):
+        now = self.clock()
+        running = [j for j in state["jobs"] if j["state"] == "running"]
+        runningUser = Counter(j["user"] for j in running)
+        usage = Counter()
+        for h in state["history"]:
+            if now - h["end"] < self.SHARE_WINDOW:
+                usage[h["user"]] += h["end"] - h["start"]
+        for j in running:
+            usage[j["user"]] += now - j["started"]
+        waiting = [j for j in state["jobs"] if j["state"] == "waiting"]
+        return sorted(waiting,key=lambda j: (runningUser[j["user"]],usage[j["user"]],j["enqueued"]))
+
+    def startable(self,running,job):
+        return (len(running) < QUEUE_LIMIT_TOTAL
+                and sum(1 for j in running if j["workstation"] == job["workstation"]) < QUEUE_LIMIT_WORKSTATION
+                and sum(1 for j in running if j["user"] == job["user"]) < QUEUE_LIMIT_USER)
+
+    # average duration of the finished jobs of the workstation (all workstations if none)
+    def averageDuration(self,state,workstation):
+        durations = [h["end"] - h["start"] for h in state["history"] if h["workstation"] == workstation]
+        if len(durations) == 0:
+            durations = [h["end"] - h["start"] for h in state["history"]]
+        if len(durations) == 0:
+            return None
+        return sum(durations) / len(durations)
+
+    # start the job if it is startable, the jobs before it in fair-share order get their slot first
+    # return True if started, else position in queue and ETA (seconds or None)
+    def tryStart(self,jobID):
+        with self.locked() as state:
+            running = [j for j in state["jobs"] if j["state"] == "running"]
+            if any(j["id"] == jobID for j in running):
+                return True,0,0
+            for position,job in enumerate(self.order(state)):
+                if job["id"] == jobID:
+                    job["heartbeat"] = self.clock()
+                    if self.startable(running,job):
+                        job["state"] = "running"
+                        job["started"] = self.clock()
+                        return True,0,0
+                    duration = self.averageDuration(state,job["workstation"])
+                    eta = None if duration is None else duration * (position // QUEUE_LIMIT_WORKSTATION + 1)
+                    return False,position + 1,eta
+                if self.startable(running,job):
+                    # slot reserved for this job
+                    running.append(job)
+        raise Exception("job %s not in import queue"%jobID)
+
+    # block until the job is started, return waiting time in seconds
+    def wait(self,jobID):
+        startTime = self.clock()
+        while True:
+            started,position,eta = self.tryStart(jobID)
+            if started:
+                break
+            print("Import queue: position %d, ETA %s"%(
+                position,"unknown" if eta is None else "%.0f min"%(eta/60)),flush=True)
+            self.sleep(QUEUE_POLL)
+
+        # keep the job alive in the queue while it is running
+        self.heartbeat = threading.Event()
+        def keepAlive():
+            while not self.heartbeat.wait(QUEUE_POLL):
+                self.update(jobID)
+        threading.Thread(target=keepAlive,daemon=True).start()
+        return self.clock() - startTime
+
+    def finish(self,jobID):
+        if self.heartbeat is not None:
+            self.heartbeat.set()
+        with self.locked() as state:
+            for j in state["jobs"]:
+                if j["id"] == jobID:
+                    state["history"].append({"user":j["user"],"workstation":j["workstation"],
+                                             "start":j.get("started",self.clock()),"end":self.clock()})
+            state["history"] = state["history"][-self.HISTORY_SIZE:]
+            state["jobs"] = [j for j in state["jobs"] if j["id"] != jobID]
+
+
+# filesystem type of the mount that contains path,
+# the last entry of a mount point is the mounted one (e.g. cifs on the autofs trigger)
+def getMountType(path):
+    path = os.path.realpath(path)
+    mountPoint,mountType = "",None
+    try:
+        with open("/proc/mounts") as f:
+            for line in f:
+                parts = line.split()
+                mnt = parts[1].replace("\\040"," ")
+                if (path == mnt or path.startswith(mnt.rstrip("/") + "/")) and len(mnt) >= len(mountPoint):
+                    mountPoint,mountType = mnt,parts[2]
+    except OSError:
+        pass
+    return mountType
+
+
+# reports new and rewritten files below root by inotify (local filesystems)
+# or by polling the mtime of the directories (POLL_FILESYSTEMS), only the changed directories are read again
+class FolderWatcher:
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_Q_OVERFLOW = 0x4000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self,root):
+        self.root = root
+        self.files = {}
+        self.dirs = {}
+        self.watches = {}
+        self.inotify = None
+        self.libc = None
+        self.initialized = False
+        if getMountType(root) not in POLL_FILESYSTEMS:
+            try:
+                self.libc = ctypes.CDLL(None,use_errno=True)
+                fd = self.libc.inotify_init1(self.IN_NONBLOCK)
+                if fd >= 0:
+                    self.inotify = fd
+            except (OSError,AttributeError):
+                self.inotify = None
+        print("Watch %s with %s"%(root,"inotify" if self.inotify is not None else "polling every %d s"%WATCH_POLL))
+        # the existing files are known, only later changes are reported
+        self.scanDir(root)
+        self.initialized = True
+
+    # read dir and its new subdirectories, return changed files
+    def scanDir(self,path):
+        changed = []
+        stack = [path]
+        while stack:
+            currentdir = stack.pop()
+            try:
+                self.dirs[currentdir] = os.stat(currentdir).st_mtime
+                if self.inotify is not None and currentdir not in self.watches.values():
+                    wd = self.libc.inotify_add_watch(self.inotify,os.fsencode(currentdir),
+                                                     self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE)
+                    if wd >= 0:
+                        self.watches[wd] = currentdir
+                with os.scandir(currentdir) as it:
+                    for entry in it:
+                        if entry.name.startswith("."):
+                            continue
+                        if entry.is_dir(follow_symlinks=False):
+                            if entry.path not in self.dirs:
+                                stack.append(entry.path)
+                        elif entry.is_file() and self.checkFile(entry.path):
+                            changed.append(entry.path)
+            except OSError:
+                # removed in the meantime
+                self.dirs.pop(currentdir,None)
+        return changed
+
+    # True if the file is new or changed since the last check
+    def checkFile(self,path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        state = (st.st_size,st.st_mtime)
+        if self.files.get(path) == state:
+            return False
+        self.files[path] = state
+        return self.initialized
+
+    # wait up to timeout seconds for changes, return set of new or changed files
+    def poll(self,timeout):
+        changed = set()
+        if self.inotify is not None:
+            readable,_,_ = select.select([self.inotify],[],[],timeout)
+            if not readable:
+                return changed
+            # collect the events of files written at the same time
+            time.sleep(1)
+            try:
+                data = os.read(self.inotify,1024 * 1024)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset < len(data):
+                wd,mask,cookie,length = self.EVENT.unpack_from(data,offset)
+                name = data[offset+self.EVENT.size:offset+self.EVENT.size+length].rstrip(b"\0")
+                offset += self.EVENT.size + length
+                if mask & self.IN_Q_OVERFLOW:
+                    # events lost, read all directories again
+                    for d in list(self.dirs):
+                        changed.update(self.scanDir(d))
+                    continue
+                if wd not in self.watches or not name or name.startswith(b"."):
+                    continue
+                path = os.path.join(self.watches[wd],os.fsdecode(name))
+                if mask & self.IN_ISDIR:
+                    changed.update(self.scanDir(path))
+                elif self.checkFile(path):
+                    changed.add(path)
+            return changed
+
+        time.sleep(timeout)
+        for d,mtime in list(self.dirs.items()):
+            try:
+                if os.stat(d).st_mtime != mtime:
+                    changed.update(self.scanDir(d))
+            except OSError:
+                self.dirs.pop(d,None)
+        return changed
+
+    def close(self):
+        if self.inotify is not None:
+            os.close(self.inotify)
+            self.inotify = None
+
+
+# dataset name of the files in relDir (relative to the import folder), see scanSubdir
+def getDatasetName(relDir,namespace):
+    if relDir == "":
+        return namespace
+    return relDir.replace(os.sep,"_")
+
+
+# copy (if COPY_SOURCES), import and attach one batch of settled files [(path, size, mtime)] of the watch mode
+# return number of imported files
+def importBatch(conn,params,srcPath,batch,destType,destID,destObj,sessions):
+    namespace = params.get(PARAM_WS)
+    files = [(os.path.relpath(path,srcPath),size,mtime) for path,size,mtime in batch]
+    root = srcPath
+    if COPY_SOURCES:
+        manifestPath = getManifestPath(conn,namespace)
+        manifest = loadManifest(manifestPath)
+        # files imported by the first run or an earlier batch
+        files = filterChangedFiles(srcPath,files,manifest)
+        if len(files) == 0:
+            return 0
+        root = create_new_repo_path(conn)
+        dirs = sorted({os.path.dirname(f[0]) for f in files if os.path.dirname(f[0])})
+        progress,files = copyTree(srcPath,root,dirs,files,throttle=getThrottle(namespace))
+
+    # files of the same directory go to the same dataset
+    groups = {}
+    for relPath,size,mtime in files:
+        groups.setdefault(os.path.dirname(relPath),[]).append(os.path.join(root,relPath))
+    if destType == "Dataset":
+        targets = {relDir:destID for relDir in groups}
+    else:
+        names = {relDir:getDatasetName(relDir,namespace) for relDir in groups}
+        datasetIndex = loadDatasetIndex(destObj)
+        missing = [name for name in dict.fromkeys(names.values()) if name not in datasetIndex]
+        datasetIndex.update(createDatasets(conn,destObj.getId(),missing))
+        targets = {relDir:datasetIndex[names[relDir]] for relDir in groups}
+    jobs = {}
+    for relDir,paths in groups.items():
+        jobs.setdefault(targets[relDir],[]).extend(paths)
+
+    patterns = None
+    if params.get(PARAM_ATTACH):
+        patterns = parseAttachFilter(params.get(PARAM_ATTACH_FILTER) or "")
+
+    numImported = 0
+    done = set()
+    for datasetID,paths in jobs.items():
+        attachList = []
+        if patterns is not None:
+            # without filter the known non image files are attached
+            attachList = [path for path in paths if
+                          (any(fnmatch.fnmatchcase(os.path.basename(path),pattern) for pattern in patterns)
+                           if patterns else path.lower().endswith(NON_IMAGE_SUFFIXES))]
+        images = [path for path in paths if path not in attachList]
+        dataset = conn.getObject("Dataset",datasetID)
+        if images:
+            print("Watch mode: import %d files into dataset %s"%(len(images),datasetID))
+            sizes = [os.path.getsize(path) for path in images]
+            profile = {"files":len(images),"bytes":sum(sizes),"small":sum(1 for size in sizes if size < SMALL_FILE_SIZE),
+                       "large":sum(1 for size in sizes if size > LARGE_IMPORT_SIZE)}
+            parallel,reason = chooseParallelism(profile,INPLACE_IMPORT)
+            skipped,imported,log = cliImport(sessions,images,datasetID,True,1,namespace,dataset,conn,None,parallel)
+            numImported += len(imported or [])
+            done.update(imported or [])
+            done.update(skipped or [])
+            # files of a fileset are imported with their leader
+            filesets = classifyFilesets(images)
+            done.update(Path(member).resolve().as_posix() for member,leader in filesets["members"].items()
+                        if Path(leader).resolve().as_posix() in done)
+        if attachList and dataset is not None:
+            attachObj = dataset if params.get(PARAM_DEST_ATTACH) == "Dataset" else dataset.getParent()
+            failed = uploadAttachments(conn,attachObj,attachList,namespace,sessions)
+            if len(failed) > 0:
+                print("ERROR attach files: %d of %d files not attached:"%(len(failed),len(attachList)))
+                print('\n'.join(failed))
+            done.update(Path(path).resolve().as_posix() for path in attachList if path not in failed)
+
+    if COPY_SOURCES:
+        # only imported files count as transferred, a run with skip transfers the others again
+        updateManifest(manifest,root,[f for f in files if Path(root,f[0]).resolve().as_posix() in done],
+                       progress.checksums)
+        saveManifest(manifestPath,manifest)
+    return numImported
+
+
+# watch mode: import new files below srcPath as soon as they are unchanged for WATCH_SETTLE seconds,
+# until PARAM_WATCH minutes are over (max. WATCH_MAX_DURATION)
+def watchImport(conn,params,srcPath,watcher):
+    destID,destObj,destType = getImportTarget(conn,params)
+    minutes = min(params.get(PARAM_WATCH),WATCH_MAX_DURATION)
+    endTime = time.time() + minutes * 60
+    print("\n Watch mode for %d min: import new files from %s"%(minutes,srcPath))
+
+    pending = {}
+    numImported = 0
+    numBatches = 0
+    sessions = SessionPool(conn.c,1 + ATTACH_SESSIONS)
+    try:
+        while time.time() < endTime:
+            for path in watcher.poll(min(WATCH_POLL,max(endTime - time.time(),0))):
+                pending[path] = None
+
+            # files are ready if size and mtime are unchanged for WATCH_SETTLE seconds
+            now = time.time()
+            ready = []
+            for path,state in list(pending.items()):
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    # removed or renamed (temporary file)
+                    del pending[path]
+                    continue
+                current = (st.st_size,st.st_mtime)
+                if state is None or state[0] != current:
+                    pending[path] = (current,now)
+                elif now - state[1] >= WATCH_SETTLE:
+                    ready.append((path,) + current)
+                    del pending[path]
+
+            if ready:
+                numBatches += 1
+                print("Watch mode: %d new files settled (batch %d)"%(len(ready),numBatches))
+                numImported += importBatch(conn,params,srcPath,ready,destType,destID,destObj,sessions)
+    except Exception as e:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        print('ERROR: watch mode: %s\n %s %s'%(str(e),exc_type, exc_tb.tb_lineno))
+    finally:
+        sessions.close()
+        watcher.close()
+
+    message = " Watch mode: %d files imported in %d batches"%(numImported,numBatches)
+    if pending:
+        message = message + ", %d files not settled at the end"%len(pending)
+    print(message)
+    return message
 
 
 def remoteImport(conn,params,datapath):
@@ -540,7 +2398,15 @@ def remoteImport(conn,params,datapath):
     if destType != "Dataset" and destType !="Project":
         return None,"ERROR:Please specify as target dataset or project!"
 
+    if params.get(PARAM_DRY_RUN):
+        return destObj,planImport(conn,params,datapath,destType,destID,destObj)
+
     startTime = time.time()
+    global runReport
+    runReport = RunReport({"workstation":params.get(PARAM_WS),"user":conn.getUser().getName(),
+                           "target":"%s:%s"%(destType,destID),"source":datapath,
+                           "start":datetime.datetime.now().isoformat(),"copy":COPY_SOURCES,
+                           "inplace":INPLACE_IMPORT})
 
     client = conn.c
     #see https://lists.openmicroscopy.org.uk/pipermail/ome-users/2014-September/004783.html
@@ -552,45 +2418,158 @@ def remoteImport(conn,params,datapath):
     else:
         raise Exception("no host configuration found")
 
-    s = client.getSession()
-    re = s.createRenderingEngine()
+    with span("session setup"):
+        if not waitUntilReady(client):
+            return destObj,"ERROR: session not ready!"
+
+    queueMessage = ""
+    if IMPORT_QUEUE:
+        importQueue = ImportQueue(QUEUE_PATH)
+        queueID = importQueue.enqueue(conn.getUser().getName(),params.get(PARAM_WS),datapath,
+                                      {"target":"%s:%s"%(destType,destID),"copy":COPY_SOURCES,
+                                       "skip":params.get(PARAM_SKIP_EXISTING),"attach":params.get(PARAM_ATTACH)})
+        waited = importQueue.wait(queueID)
+        queueMessage = " (started after %.0f min in import queue)"%(waited/60)
+
+    journal = ImportJournal(getJournalPath(conn,params.get(PARAM_WS)),
+                            {"src":datapath,"target":"%s:%s"%(destType,destID),"copy":COPY_SOURCES})
+    message = None
+    try:
+        if COPY_SOURCES:
+            # copy files to server
+            datapath,numFiles=transfer_data(conn,datapath,params.get(PARAM_WS),params.get(PARAM_SKIP_EXISTING),journal)
+            if numFiles == 0 and not journal.resumed:
+                message = "No new files to import!"
+                return destObj,message
+
+        if journal.resumed and journal.state["jobs"] is not None:
+            jobs,depth = journal.state["jobs"],journal.state["depth"]
+        else:
+            jobs,depth = getJobsAndTargets(conn,datapath,destType,destID,destObj,params.get(PARAM_WS))
+            if jobs is not None:
+                journal.setJobs(jobs,depth)
+
+        if jobs is None:
+            message = "No files found!"
+            return destObj,message
+        if IMPORT_QUEUE:
+            importQueue.update(queueID,jobs=jobs)
+
+        print("\n Import sources and destinations:")
+        for key in jobs:
+            print(key, '->', jobs[key])
+
+        with span("session setup"):
+            sessions = SessionPool(client,IMPORT_JOBS + ATTACH_SESSIONS)
+        try:
+            message = importContent(conn, params,jobs,depth,sessions,journal)
+        finally:
+            sessions.close()
+    finally:
+        runReport.info["message"] = message
+        runReport.printSummary()
+        try:
+            runReport.attach(conn,destObj,params.get(PARAM_WS))
+        except Exception as e:
+            print("WARN: can not attach run report: %s"%str(e))
+        if message is not None and message != "ERROR":
+            journal.finish()
+        else:
+            # keep the run open in the journal to resume it
+            journal.close()
+        if IMPORT_QUEUE:
+            importQueue.finish(queueID)
 
-    time.sleep(IDLETIME * 2)
+    endTime = time.time()
+    print("Duration Import: ", str(endTime - startTime))
 
-    if COPY_SOURCES:
-        # copy files to server
-        datapath=transfer_data(conn,datapath)
+    return destObj, message + queueMessage
 
-    jobs,depth = getJobsAndTargets(conn,datapath,destType,destID,destObj,params.get(PARAM_WS))
 
-    if jobs is None:
-        return destObj,"No files found!"
 
-    print("\n Import sources and destinations:")
-    for key in jobs:
-        print(key, '->', jobs[key])
+OFFLINE = " offline"
 
-    message = importContent(conn, params,jobs,depth)
+# os.path.isdir in a daemon thread, a hanging automount can not block the script
+# return True/False or None if there is no answer within timeout
+def probeDir(path,timeout=PROBE_TIMEOUT):
+    result = []
+    probe = threading.Thread(target=lambda: result.append(os.path.isdir(path)),daemon=True)
+    probe.start()
+    probe.join(timeout)
+    return result[0] if result else None
 
-    endTime = time.time()
-    print("Duration Import: ", str(endTime - startTime))
 
-    return destObj, message
+def loadProbeCache():
+    try:
+        with open(PROBE_CACHE_PATH) as f:
+            return json.load(f)
+    except Exception:
+        return {}
 
 
+def saveProbeCache(cache):
+    try:
+        tmpPath = "%s.%d.tmp"%(PROBE_CACHE_PATH,os.getpid())
+        with open(tmpPath,"w") as f:
+            json.dump(cache,f)
+        os.replace(tmpPath,PROBE_CACHE_PATH)
+    except Exception as e:
+        print("WARN: can not write workstation status cache %s: %s"%(PROBE_CACHE_PATH,str(e)))
+
+
+# probe all workstations at the same time with PROBE_TIMEOUT,
+# cached states younger than PROBE_CACHE_TTL are used without probe if useCache
+# return {workstation: True if online}
+def probeWorkstations(names,useCache=True):
+    now = time.time()
+    cache = loadProbeCache()
+    status = {}
+    if useCache:
+        for ws in names:
+            entry = cache.get(ws)
+            if entry is not None and now - entry["time"] < PROBE_CACHE_TTL:
+                status[ws] = entry["online"]
+
+    probes = {}
+    for ws in names:
+        if ws not in status:
+            result = []
+            path = os.path.join(MOUNT_PATH,ws)+os.sep
+            probes[ws] = (threading.Thread(target=lambda path=path,result=result: result.append(os.path.isdir(path)),
+                                           daemon=True),result)
+            probes[ws][0].start()
+    deadline = now + PROBE_TIMEOUT
+    for ws,(probe,result) in probes.items():
+        probe.join(max(deadline - time.time(),0))
+        status[ws] = bool(result and result[0])
+        if not result:
+            print("WARN: no answer from %s within %d s"%(ws,PROBE_TIMEOUT))
+        cache[ws] = {"online":status[ws],"time":now}
+
+    if probes:
+        saveProbeCache(cache)
+    return status
+
+
+# workstation names for the selection, "<name> offline" for workstations that are not available
+def checkWorkstations():
+    status = probeWorkstations(WORKSTATION_NAMES)
+    return [ws if status[ws] else ws + OFFLINE for ws in WORKSTATION_NAMES]
+
 
 def checkWorkstation(conn,workstation_name,mnt_path,userName):
     try:
         srcPath = os.path.join(mnt_path,workstation_name)+os.sep
         print("Check mountpath: ",srcPath)
-        if not os.path.isdir(srcPath):
+        if not probeWorkstations([workstation_name],useCache=False)[workstation_name]:
             print('ERROR: Remote system not available: ',srcPath)
+            return None
         else:
             print("==> available")
 
         serverPath = os.path.join(srcPath,userName) + os.sep
         print("Check userdir on mountpath: ",serverPath)
-        if not os.path.isdir(serverPath):
+        if not probeDir(serverPath):
             print('ERROR: No data available on remote system for user: ',userName)
             return None
         else:
@@ -632,15 +2611,17 @@ def run_script():
     
     
             """,
-            # skip already imported files will not work, because the source path change because of the timestamp
             scripts.String(PARAM_WS, optional=False, grouping="1",
-                           description="Choose a workstation where you want to import from",
-                           values=WORKSTATION_NAMES),
+                           description="Choose a workstation that is NOT offline where you want to import from",
+                           values=checkWorkstations()),
             scripts.String(PARAM_DATATYPE, optional=True, grouping="2",
                            description="Choose kind of destination object.",
                            values=dataTypes),
             scripts.Long(PARAM_ID, optional=False, grouping="3",
                          description="ID of destination object. Please select only ONE object."),
+            scripts.Bool(PARAM_SKIP_EXISTING, grouping="4",
+                         description="skip files that are already transferred and not changed since (checked transfer manifest).",
+                         default=False),
             scripts.Bool(PARAM_ATTACH, grouping="5",
                          description="Attach containing non image files", default=False),
             scripts.String(PARAM_DEST_ATTACH, grouping="5.1",
@@ -648,6 +2629,12 @@ def run_script():
                            values=dataTypes_attach, default="Dataset"),
             scripts.String(PARAM_ATTACH_FILTER, grouping="5.2",
                            description="Filter files by given file extension (for example txt, pdf). Separated by ','."),
+            scripts.Bool(PARAM_DRY_RUN, grouping="6",
+                         description="Only show the import plan (jobs, datasets, files, size, attachments, estimated duration)"
+                                     " without copying or importing.", default=False),
+            scripts.Long(PARAM_WATCH, grouping="7",
+                         description="After the import, watch the folder for this number of minutes and import new files"
+                                     " as soon as they are completely written (0: no watch mode).", default=0),
             namespaces=[omero.constants.namespaces.NSDYNAMIC],
             version="1.1.0",
             authors=["Susanne Kunis", "CellNanOs"],
@@ -672,8 +2659,8 @@ def run_script():
     
             """,
             scripts.String(PARAM_WS, optional=False, grouping="1",
-                           description="Choose a workstation where you want to import from",
-                           values=WORKSTATION_NAMES),
+                           description="Choose a workstation that is NOT offline where you want to import from",
+                           values=checkWorkstations()),
             scripts.String(PARAM_DATATYPE, optional=True, grouping="2",
                            description="Choose kind of destination object.",
                            values=dataTypes),
@@ -689,6 +2676,12 @@ def run_script():
                            values=dataTypes_attach, default="Dataset"),
             scripts.String(PARAM_ATTACH_FILTER, grouping="5.2",
                            description="Filter files by given file extension (for example txt, pdf). Separated by ','."),
+            scripts.Bool(PARAM_DRY_RUN, grouping="6",
+                         description="Only show the import plan (jobs, datasets, files, size, attachments, estimated duration)"
+                                     " without copying or importing.", default=False),
+            scripts.Long(PARAM_WATCH, grouping="7",
+                         description="After the import, watch the folder for this number of minutes and import new files"
+                                     " as soon as they are completely written (0: no watch mode).", default=0),
             namespaces=[omero.constants.namespaces.NSDYNAMIC],
             version="1.2.0",
             authors=["Susanne Kunis", "CellNanOs"],
@@ -698,13 +2691,25 @@ def run_script():
 
     try:
         params = client.getInputs(unwrap=True)
+        if params.get(PARAM_WS).endswith(OFFLINE):
+            # state of the selection may be outdated, the workstation is probed again
+            params[PARAM_WS] = params.get(PARAM_WS)[:-len(OFFLINE)]
         if os.path.exists(MOUNT_PATH):
             conn = BlitzGateway(client_obj=client)
             conn.c.enableKeepAlive(60)
 
             datapath=checkWorkstation(conn,params.get(PARAM_WS),MOUNT_PATH,conn.getUser().getName())
             if datapath:
+                watcher = None
+                if params.get(PARAM_WATCH) and not params.get(PARAM_DRY_RUN):
+                    # watch from the start to see the files written during the first import
+                    watcher = FolderWatcher(datapath)
                 robj,message=remoteImport(conn,params,datapath)
+                if watcher is not None:
+                    if robj is not None and not message.startswith("ERROR"):
+                        message = message + watchImport(conn,params,datapath,watcher)
+                    else:
+                        watcher.close()
             else:
                 message = "No data available on %s for user"%(params.get(PARAM_WS))
                 robj=None